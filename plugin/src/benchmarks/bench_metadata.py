@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+# Compares loading the metadata of a large suite once into a
+# ScreenshotIndex with parsing metadata.xml in every step of the run, as
+# pull_screenshots used to do.
+#
+# usage: python plugin/src/benchmarks/bench_metadata.py [number of screenshots]
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from os.path import join
+
+sys.path.insert(0, join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+
+from android_screenshot_tests import metadata
+
+def write_metadata(path, count):
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?><screenshots>')
+        for i in range(count):
+            name = "com.foo.Test%d_testScreenshot%d" % (i // 10, i)
+            f.write('<screenshot><description/><name>%s</name>'
+                    '<test_class>com.foo.Test%d</test_class><test_name>testScreenshot%d</test_name>'
+                    '<group>group%d</group><tile_width>1</tile_width><tile_height>2</tile_height>'
+                    '<relative_file_name>%s.png</relative_file_name>'
+                    '<relative_file_name>%s_0_1.png</relative_file_name>'
+                    '<view_hierarchy>%s_dump.xml</view_hierarchy></screenshot>'
+                    % (name, i // 10, i, i % 7, name, name, name))
+        f.write('</screenshots>')
+
+def parse_every_step(path):
+    """What a verify run used to do: validate, filter (parse and write
+    back), pull the images, generate the html, print the summary, and
+    list the screenshots in the recorder"""
+    ET.parse(path)
+    tree = ET.parse(path)
+    tree.write(path)
+    for step in range(4):
+        root = ET.parse(path).getroot()
+        for s in root.iter('screenshot'):
+            s.find('name').text
+
+def load_index_once(path):
+    index = metadata.ScreenshotIndex.load(path)
+    for step in range(4):
+        for s in index:
+            s.name
+
+def timed(func, path, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 50000
+    dir = tempfile.mkdtemp()
+    try:
+        path = join(dir, "metadata.xml")
+        write_metadata(path, count)
+        print("%d screenshots, %.1f MB of metadata" % (count, os.path.getsize(path) / 1e6))
+
+        before = timed(parse_every_step, path)
+        after = timed(load_index_once, path)
+        print("parsing in every step: %.3fs" % before)
+        print("loading the index once: %.3fs (%.1fx faster)" % (after, before / after))
+    finally:
+        shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
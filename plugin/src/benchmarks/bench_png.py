@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+# Encodes every screenshot of a corpus with each of the PNG profiles, and
+# reports the encode time and the total size per profile. The corpus is
+# a directory of PNGs, e.g. recorded goldens; without one, a synthetic
+# corpus of screenshot-like images is used.
+#
+# usage: python plugin/src/benchmarks/bench_png.py [directory of PNGs]
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os.path import join
+
+sys.path.insert(0, join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+
+from PIL import Image, ImageDraw
+
+from android_screenshot_tests.golden_store import PNG_PROFILES, save_png
+
+def synthetic_corpus(count=40, size=(720, 1280)):
+    """Flat backgrounds with toolbars, list rows and lines of "text", which
+    compress more like real screenshots than noise does"""
+    rng = random.Random(0)
+    images = []
+    for i in range(count):
+        im = Image.new("RGBA", size, (250, 250, 250, 255))
+        draw = ImageDraw.Draw(im)
+        draw.rectangle([0, 0, size[0], 120], fill=(rng.randrange(256), rng.randrange(256), 200, 255))
+        for row in range(rng.randrange(4, 12)):
+            top = 140 + row * 100
+            draw.rectangle([24, top, 104, top + 80], fill=(rng.randrange(256), 120, 120, 255))
+            for line in range(2):
+                width = rng.randrange(200, size[0] - 160)
+                draw.rectangle([128, top + 10 + line * 36, 128 + width, top + 30 + line * 36],
+                               fill=(60, 60, 60, 255))
+            draw.line([0, top + 95, size[0], top + 95], fill=(220, 220, 220, 255))
+        images.append(im)
+    return images
+
+def load_corpus(dir):
+    images = []
+    for name in sorted(os.listdir(dir)):
+        if name.endswith(".png"):
+            with Image.open(join(dir, name)) as im:
+                images.append(im.convert("RGBA"))
+    return images
+
+def encode(images, profile, dir):
+    start = time.time()
+    size = 0
+    for i, im in enumerate(images):
+        path = join(dir, "%d.png" % i)
+        save_png(im, path, profile)
+        size += os.path.getsize(path)
+    return time.time() - start, size
+
+def main(argv):
+    images = load_corpus(argv[1]) if len(argv) > 1 else synthetic_corpus()
+    dir = tempfile.mkdtemp()
+    try:
+        print("%d screenshots" % len(images))
+        results = dict((profile, encode(images, profile, dir)) for profile in PNG_PROFILES)
+        default_time, default_size = results["default"]
+        for profile in sorted(results, key=lambda profile: results[profile][0]):
+            elapsed, size = results[profile]
+            print("%-9s %7.3fs (%.2fx default)  %9.1f KB (%.2fx default)" % (
+                profile, elapsed, elapsed / default_time, size / 1e3, size / default_size))
+    finally:
+        shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+# Times every step of a run of pull_screenshots on a synthetic corpus:
+# pulling (from a fake device, with a simulated adb latency), filtering,
+# generating the report, recording and verifying. The timings are written
+# as JSON, and can be compared with the ones of an earlier run to catch
+# performance regressions, e.g. when upgrading.
+#
+# usage: python plugin/src/benchmarks/bench_suite.py [--screenshots=N] [--tiles=WxH]
+#            [--tile-size=WxH] [--extras-size=BYTES] [--latency=SECONDS] [--pull-jobs=N]
+#            [--jobs=N] [--repeat=N] [--output=timings.json]
+#            [--baseline=timings.json [--tolerance=RATIO]]
+#
+# Exits with 1 if a step got slower than the baseline by more than the
+# tolerance (0.25, i.e. 25%, by default) and by more than MIN_REGRESSION.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import getopt
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os.path import join
+
+sys.path.insert(0, join(os.path.dirname(os.path.abspath(__file__)), '..', 'py'))
+
+from PIL import Image, ImageDraw
+
+from android_screenshot_tests import common, metadata, pull_screenshots
+from android_screenshot_tests.recorder import Recorder, VerifyError
+
+PACKAGE = "com.foo.bench"
+DEVICE_DIR = "/sdcard/screenshots/%s/screenshots-default" % PACKAGE
+
+# The steps, in the order they run
+STEPS = ["pull", "pull_individual", "filter", "generate_html", "record", "verify",
+         "verify_changed"]
+
+# Share of the screenshots that are changed before verify_changed
+CHANGED_RATIO = 0.05
+
+# A step is only reported as slower if it also took this many seconds
+# more than in the baseline, since the shortest steps are mostly noise
+MIN_REGRESSION = 0.05
+
+class FakePuller(object):
+    """Serves the files of a directory standing in for the device's
+    storage, sleeping for latency seconds on every adb command"""
+
+    def __init__(self, device_root, latency):
+        self._device_root = device_root
+        self._latency = latency
+
+    def _local(self, src):
+        time.sleep(self._latency)
+        return self._device_root + src
+
+    def get_external_data_dir(self):
+        return "/sdcard"
+
+    def remote_file_exists(self, src):
+        return os.path.exists(self._local(src))
+
+    def pull(self, src, dest):
+        shutil.copyfile(self._local(src), dest)
+
+    def pull_dir(self, src, dest):
+        shutil.copytree(self._local(src), dest)
+
+    def remote_checksums(self, src):
+        src = self._local(src)
+        return dict((f, common.md5sum(join(src, f))) for f in os.listdir(src))
+
+    def remove(self, src):
+        os.unlink(self._local(src))
+
+def _tile(tile_size, seed):
+    """A tile that looks (and compresses) somewhat like a real screenshot,
+    and differs for every seed"""
+    im = Image.new("RGBA", tile_size, (250, 250, 250, 255))
+    draw = ImageDraw.Draw(im)
+    draw.rectangle([0, 0, tile_size[0], tile_size[1] // 8], fill=(seed % 256, 100, 200, 255))
+    for row in range(1, 8):
+        top = row * tile_size[1] // 8
+        width = (seed * 37 + row * 53) % tile_size[0]
+        draw.rectangle([8, top + 4, 8 + width, top + tile_size[1] // 16], fill=(60, 60, 60, 255))
+    return im
+
+def write_corpus(device_root, screenshots, tiles, tile_size, extras_size):
+    """Writes the metadata and the tiles of the given number of screenshots
+    where pull_screenshots looks for them on the device"""
+    dir = device_root + DEVICE_DIR
+    os.makedirs(dir)
+    extras = "x" * extras_size
+    with metadata.MetadataWriter(join(dir, "metadata.xml")) as writer:
+        for i in range(screenshots):
+            test_class = "com.foo.Test%d" % (i // 10)
+            s = metadata.Screenshot("%s_testScreenshot%d" % (test_class, i),
+                                    group="group%d" % (i % 10),
+                                    test_class=test_class,
+                                    test_name="testScreenshot%d" % i,
+                                    tile_width=tiles[0],
+                                    tile_height=tiles[1],
+                                    extras=[("extra", extras)] if extras_size else None)
+            s.relative_file_names = [common.get_image_file_name(s.name, x, y)
+                                     for y in range(tiles[1]) for x in range(tiles[0])]
+            for n, file_name in enumerate(s.relative_file_names):
+                im = _tile(tile_size, i * 31 + n)
+                im.save(join(dir, file_name))
+                im.close()
+            writer.write(s.to_element())
+
+def change_screenshots(dir, index, ratio):
+    """Paints over the first tile of some of the screenshots"""
+    screenshots = list(index)
+    step = max(1, int(round(1 / ratio)))
+    for s in screenshots[::step]:
+        tile = join(dir, common.get_image_file_name(s.name, 0, 0))
+        with Image.open(tile) as im:
+            changed = im.copy()
+        ImageDraw.Draw(changed).rectangle([0, 0, 10, 10], fill=(255, 0, 0, 255))
+        changed.save(tile)
+    return len(screenshots[::step])
+
+def run(device_root, work_dir, config):
+    """Runs every step once, in a fresh work_dir. Returns the seconds each
+    step took, by step."""
+    timings = {}
+    def timed(step, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[step] = time.time() - start
+
+    puller = FakePuller(device_root, config["latency"])
+    report = join(work_dir, "report")
+    os.mkdir(report)
+    timed("pull", pull_screenshots.pull_filtered, PACKAGE, report, adb_puller=puller,
+          jobs=config["pull_jobs"])
+
+    # the same pull without the bulk adb pull, as when it fails or with
+    # --incremental-pull
+    individual = join(work_dir, "individual")
+    os.mkdir(individual)
+    device_dir = pull_screenshots.pull_metadata(PACKAGE, individual, adb_puller=puller)
+    timed("pull_individual", pull_screenshots.pull_images, individual, device_dir,
+          adb_puller=puller, bulk=False, jobs=config["pull_jobs"])
+
+    filtered = join(work_dir, "filtered.xml")
+    shutil.copyfile(join(report, "metadata.xml"), filtered)
+    timed("filter", metadata.filter_screenshots, filtered,
+          screenshot_filter=metadata.ScreenshotFilter(include={"group": ["group[0-4]$"]}))
+
+    index = metadata.ScreenshotIndex.load(join(report, "metadata.xml"))
+    pull_screenshots.copy_assets(report)
+    timed("generate_html", pull_screenshots.generate_html, report, index)
+
+    goldens = join(work_dir, "goldens")
+    recorder = Recorder(report, goldens, jobs=config["jobs"], index=index)
+    timed("record", recorder.record)
+    timed("verify", recorder.verify)
+
+    change_screenshots(report, index, CHANGED_RATIO)
+    try:
+        timed("verify_changed", recorder.verify)
+        raise RuntimeError("verify did not notice the changed screenshots")
+    except VerifyError:
+        pass
+    return timings
+
+def compare(timings, baseline, tolerance):
+    """Prints every step next to its baseline. Returns the steps that got
+    slower than the baseline by more than tolerance."""
+    if baseline["config"] != timings["config"]:
+        print("warning: the baseline was measured with %s" % json.dumps(baseline["config"], sort_keys=True),
+              file=sys.stderr)
+
+    regressions = []
+    print("%-16s %10s %10s %8s" % ("step", "seconds", "baseline", "ratio"))
+    for step in STEPS:
+        seconds = timings["timings"][step]
+        before = baseline["timings"].get(step)
+        if before is None:
+            print("%-16s %10.3f %10s" % (step, seconds, "-"))
+            continue
+        ratio = seconds / before if before else float("inf")
+        slower = ratio > 1 + tolerance and seconds - before > MIN_REGRESSION
+        if slower:
+            regressions.append(step)
+        print("%-16s %10.3f %10.3f %7.2fx%s" % (step, seconds, before, ratio,
+                                                 "  SLOWER" if slower else ""))
+    return regressions
+
+def _size(value):
+    w, sep, h = value.partition("x")
+    if not sep:
+        raise ValueError("Expected WxH, got %s" % value)
+    return int(w), int(h)
+
+def usage():
+    print("usage: python plugin/src/benchmarks/bench_suite.py [--screenshots=N] "
+          "[--tiles=WxH] [--tile-size=WxH] [--extras-size=BYTES] [--latency=SECONDS] [--pull-jobs=N] "
+          "[--jobs=N] [--repeat=N] [--output=timings.json] [--baseline=timings.json [--tolerance=RATIO]]",
+          file=sys.stderr)
+
+def main(argv):
+    try:
+        opt_list, rest_args = getopt.gnu_getopt(
+            argv[1:], "",
+            ["screenshots=", "tiles=", "tile-size=", "extras-size=", "latency=", "pull-jobs=",
+             "jobs=", "repeat=", "output=", "baseline=", "tolerance="])
+        opts = dict(opt_list)
+        config = {"screenshots": int(opts.get("--screenshots", 200)),
+                  "tiles": list(_size(opts.get("--tiles", "1x2"))),
+                  "tile_size": list(_size(opts.get("--tile-size", "360x640"))),
+                  "extras_size": int(opts.get("--extras-size", 0)),
+                  "latency": float(opts.get("--latency", 0.005)),
+                  "pull_jobs": int(opts.get("--pull-jobs", 4)),
+                  "jobs": int(opts.get("--jobs", 1))}
+        repeat = int(opts.get("--repeat", 3))
+        tolerance = float(opts.get("--tolerance", 0.25))
+    except (getopt.GetoptError, ValueError):
+        usage()
+        return 2
+
+    if rest_args:
+        usage()
+        return 2
+
+    dir = tempfile.mkdtemp(prefix="bench")
+    try:
+        device_root = join(dir, "device")
+        write_corpus(device_root, config["screenshots"], config["tiles"], config["tile_size"],
+                     config["extras_size"])
+
+        # the best of every run, which is the least disturbed by whatever
+        # else runs on the machine
+        best = {}
+        for i in range(repeat):
+            work_dir = join(dir, "run%d" % i)
+            os.mkdir(work_dir)
+            for step, seconds in run(device_root, work_dir, config).items():
+                best[step] = min(seconds, best.get(step, seconds))
+            shutil.rmtree(work_dir)
+    finally:
+        shutil.rmtree(dir)
+
+    timings = {"config": config,
+               "python": platform.python_version(),
+               "timings": best}
+    if "--output" in opts:
+        with open(opts["--output"], "w") as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+
+    if "--baseline" in opts:
+        with open(opts["--baseline"]) as f:
+            baseline = json.load(f)
+        return 1 if compare(timings, baseline, tolerance) else 0
+
+    for step in STEPS:
+        print("%-16s %10.3f" % (step, best[step]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -8,6 +8,7 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 #
 
+import hashlib
 import os
 import sys
 import subprocess
@@ -31,6 +32,34 @@ def get_android_sdk():
 def get_adb():
     return os.path.join(get_android_sdk(), "platform-tools", "adb")
 
+def md5sum_command(dir):
+    """The shell command that prints the md5 checksums of the files in the
+    remote directory dir. find passes the files to md5sum in batches, so
+    that tens of thousands of them don't exceed the device's limit on the
+    length of a command line, as `md5sum *` would."""
+    return "cd %s && find . -maxdepth 1 -type f -exec md5sum {} +" % dir
+
+def parse_md5sum_output(output):
+    """Parses the output of md5sum into a dict from file name to checksum,
+    ignoring any lines that are not checksums (e.g. if md5sum is not
+    available on the device)"""
+    checksums = {}
+    for line in output.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2 and len(parts[0]) == 32:
+            name = parts[1].strip()
+            if name.startswith("./"):
+                name = name[len("./"):]
+            checksums[name] = parts[0].lower()
+    return checksums
+
+def md5sum(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 # a version of subprocess.check_output that returns a utf-8 string
 def check_output(args, **kwargs):
     return subprocess.check_output(args, **kwargs).decode('utf-8')
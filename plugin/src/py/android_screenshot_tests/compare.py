@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+# Comparators used by Recorder.verify to decide whether a stitched
+# screenshot matches its golden. A comparator is called with the decoded
+# expected and actual images, and returns None if they match, or a dict
+# describing the difference ("reason", "bbox" and "differing_pixels")
+# otherwise. The dict also has a "mask", an "L" image that is 255 for every
+# pixel that differs (None if the sizes differ), which is used for
+# drawing the diff images.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from functools import reduce
+from PIL import Image, ImageChops
+
+def _numpy():
+    # numpy is only required for the tolerant comparisons
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("numpy is required for comparing screenshots with a tolerance")
+    return numpy
+
+def _size_difference(expected, actual):
+    if expected.size == actual.size:
+        return None
+
+    return {"reason": "size",
+            "bbox": [0, 0, max(expected.size[0], actual.size[0]), max(expected.size[1], actual.size[1])],
+            "differing_pixels": None,
+            "mask": None}
+
+class ExactComparator:
+    """Only accepts images with exactly the same pixels"""
+
+    def __call__(self, expected, actual):
+        difference = _size_difference(expected, actual)
+        if difference is not None:
+            return difference
+
+        expected = expected.convert("RGBA")
+        actual = actual.convert("RGBA")
+        if expected.tobytes() == actual.tobytes():
+            return None
+
+        # the largest difference across all channels, for each pixel
+        mask = reduce(ImageChops.lighter, ImageChops.difference(expected, actual).split())
+        return {"reason": "pixels",
+                "bbox": list(mask.getbbox()),
+                "differing_pixels": mask.size[0] * mask.size[1] - mask.histogram()[0],
+                "mask": mask.point(lambda v: 255 if v else 0)}
+
+class ToleranceComparator:
+    """Accepts images where no channel of any pixel differs by more than
+    channel_tolerance, except for at most max_diff_ratio of the pixels"""
+
+    def __init__(self, channel_tolerance=0, max_diff_ratio=0.0):
+        _numpy()
+        self.channel_tolerance = channel_tolerance
+        self.max_diff_ratio = max_diff_ratio
+
+    def _differing(self, expected, actual):
+        """Returns a boolean array of the pixels that differ by more than
+        the tolerance"""
+        np = _numpy()
+        # max - min avoids widening the arrays to a signed type
+        diff = (np.maximum(expected, actual) - np.minimum(expected, actual)).max(axis=2)
+        return diff > self.channel_tolerance
+
+    def _accepts(self, expected, actual, differing, differing_pixels):
+        return differing_pixels <= self.max_diff_ratio * differing.size
+
+    def __call__(self, expected, actual):
+        difference = _size_difference(expected, actual)
+        if difference is not None:
+            return difference
+
+        np = _numpy()
+        expected = np.asarray(expected.convert("RGBA"))
+        actual = np.asarray(actual.convert("RGBA"))
+        differing = self._differing(expected, actual)
+        differing_pixels = int(np.count_nonzero(differing))
+        if differing_pixels == 0 or self._accepts(expected, actual, differing, differing_pixels):
+            return None
+
+        rows = np.flatnonzero(differing.any(axis=1))
+        cols = np.flatnonzero(differing.any(axis=0))
+        return {"reason": "pixels",
+                "bbox": [int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1],
+                "differing_pixels": differing_pixels,
+                "mask": Image.fromarray(differing.astype(np.uint8) * 255)}
+
+class SsimComparator(ToleranceComparator):
+    """Accepts images whose structural similarity (computed over blocks of
+    block_size x block_size pixels, of the luminance and of the alpha
+    separately) is at least min_ssim. The tolerance is only used to
+    describe the difference."""
+
+    def __init__(self, min_ssim, block_size=8, channel_tolerance=0):
+        ToleranceComparator.__init__(self, channel_tolerance=channel_tolerance)
+        self.min_ssim = min_ssim
+        self.block_size = block_size
+
+    def _planes(self, image):
+        """The luminance and the alpha of an RGBA array"""
+        np = _numpy()
+        image = image.astype(np.float32)
+        luminance = image[:, :, :3].dot(np.array([0.299, 0.587, 0.114], dtype=np.float32))
+        return luminance, image[:, :, 3]
+
+    def _blocks(self, plane):
+        """Splits a plane into blocks, repeating the last row and column
+        to fill the blocks at the right and bottom edges"""
+        np = _numpy()
+        b = self.block_size
+        height, width = plane.shape
+        padded = np.pad(plane, ((0, -height % b), (0, -width % b)), mode="edge")
+        return padded.reshape(padded.shape[0] // b, b, padded.shape[1] // b, b)
+
+    def ssim(self, expected, actual):
+        """The mean structural similarity of two RGBA arrays of the same
+        shape, of their luminance or of their alpha, whichever is lower"""
+        if min(expected.shape[:2]) < self.block_size:
+            return 1.0 if (expected == actual).all() else 0.0
+
+        return min(self._plane_ssim(self._blocks(x), self._blocks(y))
+                   for x, y in zip(self._planes(expected), self._planes(actual)))
+
+    def _plane_ssim(self, x, y):
+        c1 = (0.01 * 255) ** 2
+        c2 = (0.03 * 255) ** 2
+        mu_x = x.mean(axis=(1, 3))
+        mu_y = y.mean(axis=(1, 3))
+        var_x = (x * x).mean(axis=(1, 3)) - mu_x * mu_x
+        var_y = (y * y).mean(axis=(1, 3)) - mu_y * mu_y
+        cov = (x * y).mean(axis=(1, 3)) - mu_x * mu_y
+        ssim = (((2 * mu_x * mu_y + c1) * (2 * cov + c2))
+                / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)))
+        return float(ssim.mean())
+
+    def _accepts(self, expected, actual, differing, differing_pixels):
+        return self.ssim(expected, actual) >= self.min_ssim
+
+def get_comparator(channel_tolerance=0, max_diff_ratio=0.0, min_ssim=None):
+    """Returns the comparator for the given options. min_ssim replaces the
+    max_diff_ratio check, so the two can't be combined."""
+    if min_ssim is not None and max_diff_ratio:
+        raise ValueError("max_diff_ratio can't be combined with min_ssim")
+    if min_ssim is not None:
+        return SsimComparator(min_ssim, channel_tolerance=channel_tolerance)
+    if channel_tolerance or max_diff_ratio:
+        return ToleranceComparator(channel_tolerance, max_diff_ratio)
+    return ExactComparator()
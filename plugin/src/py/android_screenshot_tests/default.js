@@ -1,37 +1,62 @@
-$(function () {
-    $(".view_dump").click(function () {
-        var name = $(this).attr('data-name');
-        $.ajax(
-            {
-                url: name + "_dump.xml",
-                dataType: "text",
-                success: function(result) {
-                    window.alert(result);
-                },
-                error: function(result) {
-                    window.alert("could not load the view hierarchy for " + name);
-                }
-            });
-
-    });
-
-    $(".extra").click(function () {
-            var str = $(this).attr('data');
-            $('<pre></pre>').dialog({
-                modal: true,
-                title: "Extra Info",
-                open: function () {
-                    $(this).html(str);
-                },
-                buttons: {
-                    Ok: function () {
-                        $(this).dialog("close");
-                    }
-                },
-                width:'1000px',
-                position: {
-                    at: 'top',
-                },
-            });
-        });
+// Plain DOM code, so that the report has no dependencies that need to be
+// fetched over the network.
+
+function showDialog(title, text) {
+    var overlay = document.createElement("div");
+    overlay.className = "dialog_overlay";
+
+    var dialog = document.createElement("div");
+    dialog.className = "dialog";
+
+    var heading = document.createElement("div");
+    heading.className = "dialog_title";
+    heading.textContent = title;
+
+    var content = document.createElement("pre");
+    content.textContent = text;
+
+    var ok = document.createElement("button");
+    ok.textContent = "Ok";
+    ok.onclick = function () {
+        document.body.removeChild(overlay);
+    };
+
+    dialog.appendChild(heading);
+    dialog.appendChild(content);
+    dialog.appendChild(ok);
+    overlay.appendChild(dialog);
+    document.body.appendChild(overlay);
+}
+
+function viewDump(name) {
+    var request = new XMLHttpRequest();
+    request.onload = function () {
+        if (request.status === 200 || request.status === 0) {
+            window.alert(request.responseText);
+        } else {
+            window.alert("could not load the view hierarchy for " + name);
+        }
+    };
+    request.onerror = function () {
+        window.alert("could not load the view hierarchy for " + name);
+    };
+    request.open("GET", name + "_dump.xml");
+    request.send();
+}
+
+// a single listener for the whole page, rather than one per button
+document.addEventListener("click", function (event) {
+    var target = event.target;
+
+    if (target.classList.contains("view_dump")) {
+        viewDump(target.getAttribute("data-name"));
+    } else if (target.classList.contains("extra")) {
+        showDialog("Extra Info", target.getAttribute("data"));
+    } else if (target.classList.contains("thumbnail")) {
+        target.style.display = "none";
+        var fullSize = target.nextElementSibling;
+        if (fullSize && fullSize.classList.contains("full_size")) {
+            fullSize.style.display = "table";
+        }
+    }
 });
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+# The layouts Recorder can keep the recorded screenshots (the goldens) in:
+# loose files, content addressed blobs, or a single pack.
+#
+# A store is used from the worker processes of the recorder, so it only
+# holds its path and is cheap to pickle. put() encodes a screenshot and
+# returns its manifest entry, and commit() writes the manifest of a whole
+# record in the main process. An incremental record skips clean(): it
+# calls prepare(), puts only the screenshots that changed, and remove()s
+# the ones that are gone. entry_for() gives the manifest entry of a
+# golden that's already stored, without writing it again.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import getopt
+import hashlib
+import json
+import os
+import shutil
+import sys
+import zipfile
+
+from io import BytesIO
+from os.path import join
+from PIL import Image
+
+# Written next to the recorded screenshots, maps each screenshot name to
+# the hash of its pixels and the hash of its file
+HASH_MANIFEST = "hashes.json"
+
+# How PNGs are written. The goldens are kept in version control, so by
+# default they're compressed as much as possible, while the images only
+# written for a report (diffs, thumbnails) are compressed as fast as
+# possible. Either way the pixels are the same.
+PNG_PROFILES = {
+    "smallest": {"optimize": True},
+    "default": {},
+    "fastest": {"compress_level": 1},
+}
+GOLDEN_PNG_PROFILE = "smallest"
+REPORT_PNG_PROFILE = "fastest"
+
+def check_png_profile(profile):
+    if profile not in PNG_PROFILES:
+        raise ValueError("Unknown PNG profile %s, expected one of %s"
+                         % (profile, ", ".join(sorted(PNG_PROFILES))))
+
+def save_png(im, path, profile):
+    im.save(path, "PNG", **PNG_PROFILES[profile])
+
+def pixel_hash(im):
+    """A hash of the decoded pixels (and dimensions) of an image, which
+    unlike a hash of the file does not depend on how it was encoded"""
+    digest = hashlib.sha1(("%dx%d:" % im.size).encode('ascii'))
+    digest.update(im.convert("RGBA").tobytes())
+    return digest.hexdigest()
+
+def file_hash(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def _write_json(path, value):
+    with open(path, "w") as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+
+class DirectoryStore(object):
+    """One PNG per screenshot, named after it, in a flat directory"""
+
+    layout = "files"
+
+    def __init__(self, dir, png_profile=GOLDEN_PNG_PROFILE):
+        self.dir = dir
+        self.png_profile = png_profile
+
+    def location(self, name, entry):
+        return join(self.dir, name + ".png")
+
+    def read_manifest(self):
+        return _read_json(join(self.dir, HASH_MANIFEST))
+
+    def names(self):
+        """The names of the recorded screenshots, which for goldens recorded
+        before there was a manifest are the names of the files"""
+        manifest = self.read_manifest()
+        if manifest or not os.path.exists(self.dir):
+            return sorted(manifest)
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.dir) if f.endswith(".png"))
+
+    def clean(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+
+    def prepare(self):
+        _makedirs(self.dir)
+
+    def remove(self, name, entry):
+        if os.path.exists(self.location(name, entry)):
+            os.unlink(self.location(name, entry))
+
+    def put(self, name, im):
+        output_file = self.location(name, None)
+        save_png(im, output_file, self.png_profile)
+        return {"hash": pixel_hash(im), "file_hash": file_hash(output_file)}
+
+    def entry_for(self, name, hash):
+        return {"hash": hash, "file_hash": file_hash(self.location(name, None))}
+
+    def commit(self, manifest):
+        _write_json(join(self.dir, HASH_MANIFEST), manifest)
+
+    def exists(self, name, entry):
+        return os.path.exists(self.location(name, entry))
+
+    def is_current(self, name, entry):
+        """Whether the golden still is the file the manifest entry was
+        written for"""
+        return file_hash(self.location(name, entry)) == entry["file_hash"]
+
+    def open(self, name, entry):
+        return Image.open(self.location(name, entry))
+
+class ContentAddressedStore(object):
+    """Every distinct image is stored once, under the hash of its pixels,
+    in subdirectories named after the first two characters of the hash
+    (so that no directory gets too large). A manifest maps screenshot
+    names to hashes. Blobs that no screenshot refers to any more are only
+    deleted by gc()."""
+
+    layout = "content-addressed"
+
+    MANIFEST = "goldens.json"
+    BLOB_DIR = "blobs"
+
+    def __init__(self, dir, png_profile=GOLDEN_PNG_PROFILE):
+        self.dir = dir
+        self.png_profile = png_profile
+
+    def _blob(self, hash):
+        return join(self.dir, self.BLOB_DIR, hash[:2], hash + ".png")
+
+    def location(self, name, entry):
+        return self._blob(entry["hash"]) if entry is not None else None
+
+    def read_manifest(self):
+        return _read_json(join(self.dir, self.MANIFEST))
+
+    def names(self):
+        return sorted(self.read_manifest())
+
+    def clean(self):
+        # the blobs are kept, the manifest is replaced on commit
+        _makedirs(self.dir)
+
+    def prepare(self):
+        _makedirs(self.dir)
+
+    def remove(self, name, entry):
+        # the blob may be shared, it's only deleted by gc()
+        pass
+
+    def put(self, name, im):
+        hash = pixel_hash(im)
+        blob = self._blob(hash)
+        if not os.path.exists(blob):
+            _makedirs(os.path.dirname(blob))
+            # another worker may be writing the same image
+            partial = "%s.%d.tmp" % (blob, os.getpid())
+            save_png(im, partial, self.png_profile)
+            os.rename(partial, blob)
+        return {"hash": hash}
+
+    def entry_for(self, name, hash):
+        return {"hash": hash}
+
+    def commit(self, manifest):
+        _write_json(join(self.dir, self.MANIFEST), manifest)
+
+    def exists(self, name, entry):
+        return entry is not None and os.path.exists(self._blob(entry["hash"]))
+
+    def is_current(self, name, entry):
+        # a blob can't change without changing its name
+        return True
+
+    def open(self, name, entry):
+        return Image.open(self._blob(entry["hash"]))
+
+    def gc(self):
+        """Deletes the blobs that the manifest doesn't refer to. Returns
+        the number of blobs deleted."""
+        referenced = set(entry["hash"] for entry in self.read_manifest().values())
+        blob_dir = join(self.dir, self.BLOB_DIR)
+        if not os.path.exists(blob_dir):
+            return 0
+
+        removed = 0
+        for shard in os.listdir(blob_dir):
+            shard_dir = join(blob_dir, shard)
+            for blob in os.listdir(shard_dir):
+                if os.path.splitext(blob)[0] not in referenced:
+                    os.unlink(join(shard_dir, blob))
+                    removed += 1
+            if not os.listdir(shard_dir):
+                os.rmdir(shard_dir)
+        return removed
+
+# The packs opened by this process, by path and version, so that the
+# workers of a verify read the index of a pack only once. The process is
+# part of the key: a forked worker inherits the packs of its parent, and
+# reading through their file (and its offset) from several processes
+# corrupts what each of them reads.
+_open_packs = {}
+
+class PackStore(object):
+    """All the screenshots in a single zip file, with stored (not
+    compressed again) entries named after the screenshots, and the
+    manifest as one more entry. Reading a screenshot seeks to its entry,
+    so verify opens one file instead of thousands. The pack is rewritten
+    as a whole on commit: the workers of a record put the screenshots in
+    a staging directory next to it, and the screenshots that weren't put
+    again are copied from the previous pack."""
+
+    layout = "pack"
+
+    MANIFEST = HASH_MANIFEST
+    # zip entries get a fixed date, so that recording the same screenshots
+    # gives the same pack
+    DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+    def __init__(self, path, png_profile=GOLDEN_PNG_PROFILE):
+        self.path = path
+        self.png_profile = png_profile
+
+    def _staging(self):
+        return self.path + ".staging"
+
+    def _zip(self):
+        st = os.stat(self.path)
+        key = (os.getpid(), os.path.abspath(self.path), st.st_ino, st.st_mtime, st.st_size)
+        if key not in _open_packs:
+            _open_packs[key] = zipfile.ZipFile(self.path)
+        return _open_packs[key]
+
+    def location(self, name, entry):
+        return "%s!%s.png" % (self.path, name)
+
+    def read_manifest(self):
+        if not os.path.exists(self.path):
+            return {}
+        return json.loads(self._zip().read(self.MANIFEST).decode('utf-8'))
+
+    def names(self):
+        return sorted(self.read_manifest())
+
+    def clean(self):
+        if os.path.exists(self._staging()):
+            shutil.rmtree(self._staging())
+
+    def prepare(self):
+        self.clean()
+        if os.path.dirname(self.path):
+            _makedirs(os.path.dirname(self.path))
+
+    def remove(self, name, entry):
+        # the pack is rewritten from the manifest on commit
+        pass
+
+    def put(self, name, im):
+        _makedirs(self._staging())
+        save_png(im, join(self._staging(), name + ".png"), self.png_profile)
+        return {"hash": pixel_hash(im)}
+
+    def entry_for(self, name, hash):
+        return {"hash": hash}
+
+    def _entry(self, name):
+        return zipfile.ZipInfo(name, date_time=self.DATE_TIME)
+
+    def commit(self, manifest):
+        partial = self.path + ".tmp"
+        with zipfile.ZipFile(partial, "w", zipfile.ZIP_STORED, allowZip64=True) as pack:
+            pack.writestr(self._entry(self.MANIFEST),
+                          json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+            for name in sorted(manifest):
+                staged = join(self._staging(), name + ".png")
+                if os.path.exists(staged):
+                    with open(staged, "rb") as f:
+                        data = f.read()
+                else:
+                    data = self._zip().read(name + ".png")
+                pack.writestr(self._entry(name + ".png"), data)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(partial, self.path)
+        self.clean()
+
+    def exists(self, name, entry):
+        return entry is not None
+
+    def is_current(self, name, entry):
+        # the pack is only ever written together with its manifest
+        return True
+
+    def open(self, name, entry):
+        return Image.open(BytesIO(self._zip().read(name + ".png")))
+
+LAYOUTS = dict((store.layout, store) for store in [DirectoryStore, ContentAddressedStore, PackStore])
+
+def check_layout(layout):
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown golden layout %s, expected one of %s"
+                         % (layout, ", ".join(sorted(LAYOUTS))))
+
+def open_store(path, layout=None, png_profile=GOLDEN_PNG_PROFILE):
+    """Returns the store for the goldens at path. Without a layout, it's
+    detected from what's already there (a new store has loose files,
+    unless path is a .zip)."""
+    if layout is None:
+        if path.endswith(".zip") or os.path.isfile(path):
+            layout = PackStore.layout
+        elif os.path.exists(join(path, ContentAddressedStore.MANIFEST)):
+            layout = ContentAddressedStore.layout
+        else:
+            layout = DirectoryStore.layout
+    check_layout(layout)
+    check_png_profile(png_profile)
+    return LAYOUTS[layout](path, png_profile)
+
+def convert(src, dest):
+    """Copies every screenshot of the store src into the (emptied) store
+    dest, e.g. to pack a directory of loose files, or to unpack it
+    again"""
+    dest.clean()
+    manifest = src.read_manifest()
+    entries = {}
+    for name in src.names():
+        with src.open(name, manifest.get(name)) as im:
+            entries[name] = dest.put(name, im)
+    dest.commit(entries)
+    return len(entries)
+
+def usage():
+    print("usage: python -m android_screenshot_tests.golden_store gc <golden dir>\n"
+          "       python -m android_screenshot_tests.golden_store convert <from> <to> [--layout=%s] [--png-profile=%s]"
+          % ("|".join(sorted(LAYOUTS)), "|".join(sorted(PNG_PROFILES))),
+          file=sys.stderr)
+
+def main(argv):
+    try:
+        opt_list, rest_args = getopt.gnu_getopt(argv[1:], "", ["layout=", "png-profile="])
+    except getopt.GetoptError:
+        usage()
+        return 2
+
+    opts = dict(opt_list)
+    if len(rest_args) == 3 and rest_args[0] == "convert":
+        src = open_store(rest_args[1])
+        try:
+            dest = open_store(rest_args[2], opts.get('--layout'),
+                              opts.get('--png-profile', GOLDEN_PNG_PROFILE))
+        except ValueError:
+            usage()
+            return 2
+        print("Copied %d screenshots from %s to %s" % (convert(src, dest), rest_args[1], rest_args[2]))
+        return 0
+
+    if len(rest_args) != 2 or rest_args[0] != "gc":
+        usage()
+        return 2
+
+    store = open_store(rest_args[1])
+    if not hasattr(store, "gc"):
+        print("%s doesn't have a content addressed layout, there is nothing to collect" % rest_args[1],
+              file=sys.stderr)
+        return 1
+
+    print("Removed %d unreferenced screenshots" % store.gc())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
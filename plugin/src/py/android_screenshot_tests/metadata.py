@@ -19,18 +19,226 @@ import os
 import xml.etree.ElementTree as ET
 import re
 
+def iter_screenshot_elements(metadata_file):
+    """Yields the <screenshot> elements of a metadata file one at a
+    time. Each element is cleared once the caller is done with it, so
+    the whole tree is never held in memory."""
+    root = None
+    for event, element in ET.iterparse(metadata_file, events=('start', 'end')):
+        if root is None:
+            root = element
+        elif event == 'end' and element.tag == 'screenshot':
+            yield element
+            element.clear()
+            root.clear()
+
+class MetadataWriter(object):
+    """Writes a metadata file one <screenshot> element at a time"""
+
+    def __init__(self, metadata_file):
+        self._metadata_file = metadata_file
+        self._out = None
+
+    def __enter__(self):
+        self._out = open(self._metadata_file, 'wb')
+        self._out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<screenshots>')
+        return self
+
+    def write(self, element):
+        element.tail = None
+        self._out.write(ET.tostring(element))
+
+    def __exit__(self, *exc_info):
+        self._out.write(b'</screenshots>\n')
+        self._out.close()
+
+def _text(element, tag):
+    node = element.find(tag)
+    return node.text if node is not None else None
+
+def _int(element, tag):
+    text = _text(element, tag)
+    return int(text) if text is not None else None
+
+def _strip(text):
+    return text.strip() if text is not None else None
+
+class Screenshot(object):
+    """A single <screenshot> of the metadata. There can be tens of
+    thousands of these in a run, hence the slots."""
+
+    __slots__ = ('name', 'group', 'test_class', 'test_name', 'description',
+                 'tile_width', 'tile_height', 'relative_file_names',
+                 'view_hierarchy', 'extras', 'error')
+
+    def __init__(self, name, group=None, test_class=None, test_name=None, description=None,
+                 tile_width=None, tile_height=None, relative_file_names=(),
+                 view_hierarchy=None, extras=None, error=None):
+        self.name = name
+        self.group = group
+        self.test_class = test_class
+        self.test_name = test_name
+        self.description = description
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.relative_file_names = list(relative_file_names)
+        self.view_hierarchy = view_hierarchy
+        # a list of (tag, text), or None if the screenshot has no extras
+        self.extras = extras
+        self.error = error
+
+    @classmethod
+    def from_element(cls, s):
+        extras = s.find('extras')
+        return cls(_text(s, 'name'),
+                   group=_text(s, 'group'),
+                   test_class=_strip(_text(s, 'test_class')),
+                   test_name=_strip(_text(s, 'test_name')),
+                   description=_text(s, 'description'),
+                   tile_width=_int(s, 'tile_width'),
+                   tile_height=_int(s, 'tile_height'),
+                   relative_file_names=[node.text for node in s.findall('relative_file_name')],
+                   view_hierarchy=_text(s, 'view_hierarchy'),
+                   extras=[(node.tag, node.text) for node in extras] if extras is not None else None,
+                   error=_text(s, 'error'))
+
+    def to_element(self):
+        s = ET.Element('screenshot')
+
+        def add(tag, value):
+            if value is not None:
+                ET.SubElement(s, tag).text = "%s" % value
+
+        add('description', self.description)
+        add('name', self.name)
+        add('test_class', self.test_class)
+        add('test_name', self.test_name)
+        add('group', self.group)
+        add('tile_width', self.tile_width)
+        add('tile_height', self.tile_height)
+        for relative_file_name in self.relative_file_names:
+            add('relative_file_name', relative_file_name)
+        add('view_hierarchy', self.view_hierarchy)
+        if self.extras is not None:
+            extras = ET.SubElement(s, 'extras')
+            for tag, text in self.extras:
+                ET.SubElement(extras, tag).text = text
+        add('error', self.error)
+        return s
+
+    def device_files(self):
+        """The device paths (relative to the screenshot directory) of the
+        tiles and the view hierarchy dump of this screenshot"""
+        files = list(self.relative_file_names)
+        if self.view_hierarchy is not None:
+            files.append(self.view_hierarchy)
+        return files
+
+class ScreenshotIndex(object):
+    """All the screenshots of a metadata file. This is loaded once per
+    run and passed along from the pull to the report and to the
+    recorder, instead of each of them parsing metadata.xml again."""
+
+    def __init__(self, screenshots=()):
+        self.screenshots = list(screenshots)
+
+    @classmethod
+    def load(cls, metadata_file):
+        return cls(Screenshot.from_element(s) for s in iter_screenshot_elements(metadata_file))
+
+    def __iter__(self):
+        return iter(self.screenshots)
+
+    def __len__(self):
+        return len(self.screenshots)
+
+    def device_files(self):
+        return [f for s in self.screenshots for f in s.device_files()]
+
+# The fields of a screenshot that can be filtered on
+FILTER_FIELDS = ('name', 'group', 'test_class', 'test_name')
+
+class ScreenshotFilter(object):
+    """Selects the screenshots of a run.
+
+    include and exclude map fields of FILTER_FIELDS to lists of regular
+    expressions, which are compiled once up front. A screenshot is
+    selected if, for every field in include, one of the expressions
+    matches, if none of the expressions in exclude match, and if its name
+    is one of names (unless names is None)."""
+
+    def __init__(self, include={}, exclude={}, names=None):
+        for field in list(include) + list(exclude):
+            if field not in FILTER_FIELDS:
+                raise ValueError("Can't filter screenshots by %s, only by %s"
+                                 % (field, ", ".join(FILTER_FIELDS)))
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+        self._names = frozenset(names) if names is not None else None
+
+    def _compile(self, regexes):
+        return [(field, [re.compile(regex) for regex in regexes[field]])
+                for field in FILTER_FIELDS if regexes.get(field)]
+
+    def is_empty(self):
+        return not self._include and not self._exclude and self._names is None
+
+    def __call__(self, screenshot):
+        if self._names is not None and screenshot.name not in self._names:
+            return False
+        for field, regexes in self._include:
+            value = getattr(screenshot, field) or ""
+            if not any(regex.search(value) for regex in regexes):
+                return False
+        for field, regexes in self._exclude:
+            value = getattr(screenshot, field) or ""
+            if any(regex.search(value) for regex in regexes):
+                return False
+        return True
+
 # Given a metadata file locally, this transforms it (in-place), to
 # remove any screenshot elements that don't satisfy the given filter
-# criteria
-def filter_screenshots(metadata_file, name_regex=None):
-    parsed = ET.parse(metadata_file)
-    root = parsed.getroot()
-    to_remove = []
-    for s in root.iter('screenshot'):
-        if name_regex and not (re.search(name_regex, s.find('name').text)):
-            to_remove.append(s)
-
-    for s in to_remove:
-        root.remove(s)
-
-    parsed.write(metadata_file)
+# criteria. Returns the index of the remaining screenshots. The file is
+# streamed through, and the screenshots that are kept are copied as they
+# are.
+def filter_screenshots(metadata_file, name_regex=None, screenshot_filter=None):
+    filters = [f for f in [ScreenshotFilter(include={'name': [name_regex]}) if name_regex else None,
+                           screenshot_filter]
+               if f is not None and not f.is_empty()]
+    if not filters:
+        return ScreenshotIndex.load(metadata_file)
+
+    kept = []
+    filtered_file = metadata_file + ".filtered"
+    try:
+        with MetadataWriter(filtered_file) as writer:
+            for element in iter_screenshot_elements(metadata_file):
+                screenshot = Screenshot.from_element(element)
+                if all(f(screenshot) for f in filters):
+                    writer.write(element)
+                    kept.append(screenshot)
+    except Exception:
+        os.unlink(filtered_file)
+        raise
+
+    os.unlink(metadata_file)
+    os.rename(filtered_file, metadata_file)
+    return ScreenshotIndex(kept)
+
+# Merges the given metadata files (e.g. one per device when the tests
+# are sharded across several devices) into a single metadata file. A
+# screenshot name may only appear once across all the inputs.
+def merge_metadata(metadata_files, output_file):
+    sources = {}
+    collisions = []
+    with MetadataWriter(output_file) as writer:
+        for metadata_file in metadata_files:
+            for s in iter_screenshot_elements(metadata_file):
+                name = s.find('name').text
+                if name in sources:
+                    collisions.append("%s (in %s and %s)" % (name, sources[name], metadata_file))
+                sources[name] = metadata_file
+                writer.write(s)
+
+    if collisions:
+        raise RuntimeError("Screenshot names collide across devices: " + ", ".join(collisions))
@@ -18,9 +18,15 @@ import tempfile
 import subprocess
 import xml.etree.ElementTree as ET
 import getopt
+import io
+import json
+import re
 import shutil
+import time
+from multiprocessing.pool import ThreadPool
 from . import metadata
 from .simple_puller import SimplePuller
+from .sync_puller import SyncPuller
 import zipfile
 from . import aapt
 from . import common
@@ -30,89 +36,213 @@ from os.path import abspath
 
 OLD_ROOT_SCREENSHOT_DIR = '/data/data/'
 
+# Number of times a failed pull is retried before giving up on the
+# file, and the delay before the first retry (doubled on every retry)
+PULL_RETRIES = 2
+PULL_RETRY_DELAY = 0.5
+
+HOST_FILE_SENDER_STATUS = "INSTRUMENTATION_STATUS: HostFileSender_filename="
+INSTRUMENTATION_STATUS_CODE = "INSTRUMENTATION_STATUS_CODE:"
+INSTRUMENTATION_CODE = "INSTRUMENTATION_CODE:"
+
+# Activity.RESULT_OK, the code of an instrumentation that finished
+INSTRUMENTATION_OK_CODE = "-1"
+
+# the status code of a failing test
+TEST_FAILED_STATUS_CODE = "-2"
+
+METADATA_PARSE_ERROR = "Unable to parse metadata file, this commonly happens if you did not call ScreenshotRunner.onDestroy() from your instrumentation"
+
+# Above this many screenshots, the report is split into one page per
+# group (or test class), and index.html only links to those
+REPORT_PAGE_THRESHOLD = 500
+
+# Written by Recorder.verify, kept in sync with recorder.VERIFY_REPORT
+# and recorder.VERIFY_FAILURES (which we can't import here without
+# requiring PIL)
+VERIFY_REPORT = "verify_report.json"
+VERIFY_FAILURES = "verify_failures"
+
 def usage():
-    print >>sys.stderr, "usage: ./scripts/screenshot_tests/pull_screenshots com.facebook.apk.name.tests [--generate-png]"
+    print("usage: ./scripts/screenshot_tests/pull_screenshots com.facebook.apk.name.tests [-s serial]... [--generate-png] [--jobs=N] [--channel-tolerance=N] [--max-diff-ratio=R] [--min-ssim=S] [--pull-jobs=N] [--persistent-adb] [--incremental-pull --temp-dir=dir] [--instrument=test.package/runner.Class] [--include=FIELD:REGEX]... [--exclude=FIELD:REGEX]... [--only-failed=verify_report.json] [--thumbnails [--thumbnail-cache=dir]] [--golden-layout=files|content-addressed|pack] [--incremental-record] [--golden-png=smallest|default|fastest] [--report-png=smallest|default|fastest]",
+          file=sys.stderr)
     return
 
 def sort_screenshots(screenshots):
     def sort_key(screenshot):
-        group = screenshot.find('group')
+        return (screenshot.group or "", screenshot.name)
 
-        group = group.text if group is not None else ""
+    return sorted(list(screenshots), key=sort_key)
 
-        return (group, screenshot.find('name').text)
+def read_verify_failures(report_file):
+    """Returns the failures in a report written by verify, by screenshot
+    name"""
+    with open(report_file) as f:
+        return dict((failure["name"], failure) for failure in json.load(f)["failures"])
+
+def _clean_verify_results(dir):
+    """Removes the results of a verify by an earlier run in the same dir,
+    so that the report doesn't show them as failures of this run"""
+    if os.path.exists(join(dir, VERIFY_REPORT)):
+        os.unlink(join(dir, VERIFY_REPORT))
+    if os.path.exists(join(dir, VERIFY_FAILURES)):
+        shutil.rmtree(join(dir, VERIFY_FAILURES))
+
+def _verify_failures(dir):
+    """Returns the failures of the last verify of dir, by screenshot name"""
+    report_file = join(dir, VERIFY_REPORT)
+    if not os.path.exists(report_file):
+        return {}
+    return read_verify_failures(report_file)
+
+class HtmlBuffer(object):
+    """Collects the html of a page in memory, so that it's written to
+    disk in one go instead of in many tiny writes"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, html):
+        self._parts.append(html)
+
+    def save(self, path):
+        with io.open(path, "w", encoding="utf-8") as f:
+            f.write("".join(self._parts))
+
+def _page_key(screenshot):
+    return screenshot.group or screenshot.test_class or ""
+
+def _write_head(html):
+    html.write('<!DOCTYPE html>')
+    html.write('<html>')
+    html.write('<head>')
+    html.write('<meta charset="utf-8">')
+    # only local assets (see copy_assets), so that rendering the report
+    # never waits for the network
+    html.write('<script src="default.js" defer></script>')
+    html.write('<link rel="stylesheet" href="default.css"></head>')
+    html.write('<body>')
+
+def generate_html(dir, index=None, thumbnails={}, paginate=True):
+    """Writes the report for the screenshots in dir, and returns the path
+    of its index.html. Large suites are split into one page per group (or
+    test class), which index.html links to, unless paginate is False
+    (e.g. when index.html is rendered to a PNG, which can't follow the
+    links). thumbnails maps screenshot names to the thumbnails to show
+    instead of their tiles."""
+    if index is None:
+        index = _load_index(dir)
+    failures = _verify_failures(dir)
+    index_html = abspath(join(dir, "index.html"))
+    # listed once, instead of checking for every tile on its own
+    files = frozenset(os.listdir(dir))
 
-    return sorted(list(screenshots), key=sort_key)
+    if not paginate or len(index) <= REPORT_PAGE_THRESHOLD:
+        write_page(dir, index_html, sort_screenshots(index), failures, thumbnails, files)
+        return index_html
 
-def generate_html(dir):
-    root = ET.parse(join(dir, 'metadata.xml')).getroot()
+    pages = {}
+    for screenshot in index:
+        pages.setdefault(_page_key(screenshot), []).append(screenshot)
+
+    html = HtmlBuffer()
+    _write_head(html)
+    html.write('<ul class="pages">')
+    for i, key in enumerate(sorted(pages)):
+        page = "page_%d.html" % (i + 1)
+        screenshots = sort_screenshots(pages[key])
+        write_page(dir, join(dir, page), screenshots, failures, thumbnails, files)
+
+        failed = len([s for s in screenshots if s.name in failures])
+        html.write('<li><a href="%s">%s</a> (%d screenshots%s)</li>' % (
+            page, key or "Other", len(screenshots), ", %d failed" % failed if failed else ""))
+    html.write('</ul>')
+    html.write('</body></html>')
+    html.save(index_html)
+    return index_html
+
+def write_page(dir, path, screenshots, failures, thumbnails={}, files=None):
+    if files is None:
+        files = frozenset(os.listdir(dir))
     alternate = False
-    index_html = abspath(join(dir, "index.html"))
-    with open(index_html, "w") as html:
-        html.write('<!DOCTYPE html>')
-        html.write('<html>')
-        html.write('<head>')
-        html.write('<script src="https://ajax.googleapis.com/ajax/libs/jquery/2.1.3/jquery.min.js"></script>')
-        html.write('<script src="https://ajax.googleapis.com/ajax/libs/jqueryui/1.11.3/jquery-ui.min.js"></script>')
-        html.write('<script src="default.js"></script>')
-        html.write('<link rel="stylesheet" href="https://ajax.googleapis.com/ajax/libs/jqueryui/1.11.3/themes/smoothness/jquery-ui.css" />')
-        html.write('<link rel="stylesheet" href="default.css"></head>')
-        html.write('<body>')
-
-        html.write('<!-- begin results -->')
-
-        for screenshot in sort_screenshots(root.iter('screenshot')):
-            alternate = not alternate
-            html.write('<div class="screenshot %s">' % ('alternate' if alternate else ''))
-            html.write('<div class="screenshot_name">%s</div>' % (screenshot.find('name').text))
-
-            group = screenshot.find('group')
-
-            if group:
-                html.write('<div class="screenshot_group">%s</div>' % group.text)
-
-            html.write('<button class="view_dump" data-name="%s">Dump view hierarchy</button>' % (screenshot.find('name').text))
-
-            extras = screenshot.find('extras')
-            if extras is not None:
-                str = ""
-                for node in extras:
-                    if node.text is not None:
-                        str = str + "*****" + node.tag + "*****\n\n" + node.text + "\n\n\n"
-                if str != "":
-                    extra_html = '<button class="extra" data="%s">Extra info</button>' % str
-                    html.write(extra_html.encode('utf-8').strip())
-
-            description = screenshot.find('description')
-            if description is not None:
-                html.write('<div class="screenshot_description">%s</div>' % description.text)
-
-            error = screenshot.find('error')
-            if error is not None:
-                html.write('<div class="screenshot_error">%s</div>' % error.text)
-            else:
-                write_image(dir, html, screenshot)
+    html = HtmlBuffer()
+    _write_head(html)
 
-            html.write('</div>')
+    html.write('<!-- begin results -->')
 
-        html.write('</body></html>')
-        return index_html
+    for screenshot in screenshots:
+        alternate = not alternate
+        html.write('<div class="screenshot %s">' % ('alternate' if alternate else ''))
+        html.write('<div class="screenshot_name">%s</div>' % (screenshot.name))
+
+        if screenshot.group:
+            html.write('<div class="screenshot_group">%s</div>' % screenshot.group)
+
+        html.write('<button class="view_dump" data-name="%s">Dump view hierarchy</button>' % (screenshot.name))
+
+        if screenshot.extras is not None:
+            str = ""
+            for tag, text in screenshot.extras:
+                if text is not None:
+                    str = str + "*****" + tag + "*****\n\n" + text + "\n\n\n"
+            if str != "":
+                extra_html = '<button class="extra" data="%s">Extra info</button>' % str
+                html.write(extra_html.strip())
 
-def write_image(dir, html, screenshot):
-    html.write('<table class="img-wrapper">')
-    for y in range(int(screenshot.find('tile_height').text)):
+        if screenshot.description is not None:
+            html.write('<div class="screenshot_description">%s</div>' % screenshot.description)
+
+        if screenshot.error is not None:
+            html.write('<div class="screenshot_error">%s</div>' % screenshot.error)
+        else:
+            write_image(dir, html, screenshot, thumbnails.get(screenshot.name), files)
+
+        failure = failures.get(screenshot.name)
+        if failure is not None:
+            write_failure(dir, html, failure)
+
+        html.write('</div>')
+
+    html.write('</body></html>')
+    html.save(path)
+
+def write_image(dir, html, screenshot, thumbnail=None, files=None):
+    """Writes the table of tiles of a screenshot. files is the listing of
+    dir, which is used to leave out the tiles that weren't pulled."""
+    if files is None:
+        files = frozenset(os.listdir(dir))
+    if thumbnail is not None:
+        # the full size tiles are only shown once the thumbnail is clicked
+        html.write('<img class="thumbnail" src="%s" loading="lazy" />' % thumbnail)
+        html.write('<table class="img-wrapper full_size">')
+    else:
+        html.write('<table class="img-wrapper">')
+    for y in range(screenshot.tile_height):
         html.write('<tr>')
-        for x in range(int(screenshot.find('tile_width').text)):
+        for x in range(screenshot.tile_width):
             html.write('<td>')
-            image_file = "./" + common.get_image_file_name(screenshot.find('name').text, x, y)
+            image_file = common.get_image_file_name(screenshot.name, x, y)
 
-            if os.path.exists(join(dir, image_file)):
-                html.write('<img src="%s" />' % image_file)
+            if image_file in files:
+                html.write('<img src="./%s" loading="lazy" />' % image_file)
 
             html.write('</td>')
         html.write('</tr>')
     html.write('</table>')
 
+def write_failure(dir, html, failure):
+    html.write('<div class="screenshot_failure">')
+    html.write('<div class="screenshot_error">Does not match the recorded screenshot (%s)</div>' % failure["reason"])
+
+    links = [(kind, failure.get(kind)) for kind in ["expected", "actual", "diff"]]
+    for kind, path in links:
+        if path is not None and os.path.exists(path):
+            html.write('<a href="%s">%s</a> ' % (os.path.relpath(path, dir), kind))
+
+    composite = failure.get("composite")
+    if composite is not None:
+        html.write('<img class="composite" src="%s" loading="lazy" />' % os.path.relpath(composite, dir))
+    html.write('</div>')
 
 def test_for_wkhtmltoimage():
     if subprocess.call(['which', 'wkhtmltoimage']) != 0:
@@ -203,38 +333,258 @@ def create_empty_metadata_file(dir):
 <screenshots>
 </screenshots>""")
 
-def pull_images(dir, device_dir, adb_puller):
-    root = ET.parse(join(dir, 'metadata.xml')).getroot()
-    for s in root.iter('screenshot'):
-        filename_nodes = s.findall('relative_file_name')
-        for filename_node in filename_nodes:
-            adb_puller.pull(
-                android_path_join(device_dir, filename_node.text),
-                join(dir, os.path.basename(filename_node.text)))
-        dump_node = s.find('view_hierarchy')
-        if dump_node is not None:
-            adb_puller.pull(android_path_join(device_dir, dump_node.text), join(dir, os.path.basename(dump_node.text)))
-
-def pull_all(package, dir, adb_puller):
-    device_dir = pull_metadata(package, dir, adb_puller=adb_puller)
-    pull_images(dir, device_dir, adb_puller=adb_puller)
+def _bulk_pull(dir, device_dir, files, adb_puller):
+    """Pulls the whole device_dir with a single adb invocation and moves
+    the given files into dir. Returns the files that were not
+    retrieved this way, which still need to be pulled individually."""
+    staging = tempfile.mkdtemp(prefix='bulk', dir=dir)
+    try:
+        try:
+            adb_puller.pull_dir(device_dir, join(staging, 'files'))
+        except (subprocess.CalledProcessError, OSError) as e:
+            print("Bulk pull of %s failed, falling back to pulling files individually: %s"
+                  % (device_dir, e), file=sys.stderr)
+
+        missing = []
+        for f in files:
+            pulled = join(staging, 'files', f)
+            if os.path.exists(pulled):
+                shutil.move(pulled, join(dir, os.path.basename(f)))
+            else:
+                missing.append(f)
+        return missing
+    finally:
+        shutil.rmtree(staging)
+
+def _pull_file(adb_puller, src, dest, retries=PULL_RETRIES):
+    """Pulls a single file, retrying transient adb failures. Returns
+    None on success, or the last error if every attempt failed."""
+    for attempt in range(retries + 1):
+        try:
+            adb_puller.pull(src, dest)
+            return None
+        except (subprocess.CalledProcessError, OSError) as e:
+            error = e
+            if attempt < retries:
+                time.sleep(PULL_RETRY_DELAY * (2 ** attempt))
+    return error
+
+def _pull_files(dir, device_dir, files, adb_puller, jobs=1):
+    """Pulls each of the given files into dir, using up to jobs
+    concurrent pulls. Returns a list of (file, error) for the files that
+    could not be pulled."""
+    def pull(f):
+        return f, _pull_file(adb_puller,
+                             android_path_join(device_dir, f),
+                             join(dir, os.path.basename(f)))
+
+    if jobs > 1 and len(files) > 1:
+        pool = ThreadPool(min(jobs, len(files)))
+        try:
+            results = pool.map(pull, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [pull(f) for f in files]
+
+    failures = [(f, error) for f, error in results if error is not None]
+    for f, error in failures:
+        print("Could not pull %s: %s" % (f, error), file=sys.stderr)
+    return failures
+
+def _changed_files(dir, device_dir, files, adb_puller):
+    """Returns the files that are missing in dir, or whose contents
+    differ from the copy on the device"""
+    checksums = adb_puller.remote_checksums(device_dir)
+    if not checksums:
+        print("Could not checksum the files on the device, pulling all of them again",
+              file=sys.stderr)
+    changed = []
+    for f in files:
+        local_file = join(dir, os.path.basename(f))
+        if not (f in checksums and os.path.exists(local_file)
+                and common.md5sum(local_file) == checksums[f]):
+            changed.append(f)
+    return changed
+
+def pull_images(dir, device_dir, adb_puller, bulk=True, jobs=1, incremental=False, only_missing=False,
+                index=None):
+    """Pulls all the tiles and view hierarchy dumps listed in the
+    metadata. Returns a list of (file, error) for the files that could
+    not be pulled.
+
+    With incremental, files already in dir that match the device's copy
+    are not pulled again. With only_missing, no file that is already in
+    dir is pulled again."""
+    if index is None:
+        index = _load_index(dir)
+    files = index.device_files()
+    if only_missing:
+        remaining = [f for f in files if not os.path.exists(join(dir, os.path.basename(f)))]
+    elif incremental and files:
+        remaining = _changed_files(dir, device_dir, files, adb_puller)
+        print("Skipping %d unchanged files" % (len(files) - len(remaining)))
+    else:
+        remaining = files
+
+    # pulling the whole directory only pays off if nothing was reused
+    bulk = bulk and len(remaining) == len(files)
+    files = remaining
+
+    if bulk and files:
+        files = _bulk_pull(dir, device_dir, files, adb_puller)
+
+    return _pull_files(dir, device_dir, files, adb_puller, jobs=jobs)
 
-def pull_filtered(package, dir, adb_puller, filter_name_regex=None):
+def pull_all(package, dir, adb_puller, jobs=1):
     device_dir = pull_metadata(package, dir, adb_puller=adb_puller)
-    _validate_metadata(dir)
-    metadata.filter_screenshots(join(dir, 'metadata.xml'), name_regex=filter_name_regex)
-    pull_images(dir, device_dir, adb_puller=adb_puller)
+    return pull_images(dir, device_dir, adb_puller=adb_puller, jobs=jobs)
 
-def _summary(dir):
-    root = ET.parse(join(dir, 'metadata.xml')).getroot()
-    count = len(root.findall('screenshot'))
-    print("Found %d screenshots" % count)
+def _pull_filtered(package, dir, adb_puller, filter_name_regex=None, jobs=1, incremental=False,
+                   only_missing=False, screenshot_filter=None):
+    """Like pull_filtered, but also returns the index of the pulled
+    screenshots, so that the caller doesn't have to load it again"""
+    device_dir = pull_metadata(package, dir, adb_puller=adb_puller)
+    try:
+        index = metadata.filter_screenshots(join(dir, 'metadata.xml'),
+                                            name_regex=filter_name_regex,
+                                            screenshot_filter=screenshot_filter)
+    except ET.ParseError:
+        raise RuntimeError(METADATA_PARSE_ERROR)
+    # a bulk pull would also transfer the screenshots that were filtered out
+    filtered = filter_name_regex is not None or (screenshot_filter is not None
+                                                 and not screenshot_filter.is_empty())
+    failures = pull_images(dir, device_dir, adb_puller=adb_puller, bulk=not filtered,
+                           jobs=jobs, incremental=incremental, only_missing=only_missing, index=index)
+    return index, failures
+
+def pull_filtered(package, dir, adb_puller, filter_name_regex=None, jobs=1, incremental=False,
+                  only_missing=False, screenshot_filter=None):
+    """Pulls the metadata, and then only the tiles and dumps of the
+    screenshots that pass the filters"""
+    return _pull_filtered(package, dir, adb_puller, filter_name_regex=filter_name_regex, jobs=jobs,
+                          incremental=incremental, only_missing=only_missing,
+                          screenshot_filter=screenshot_filter)[1]
+
+def _host_sender_files(lines):
+    """Yields the device paths that HostFileSender announces in the
+    status stream of `am instrument -r`, echoing the final result of
+    the instrumentation along the way. Raises a RuntimeError at the end
+    of the stream if the instrumentation failed, a test failed, or the
+    instrumentation never finished (e.g. because the app crashed)."""
+    failed_tests = 0
+    failure = None
+    code = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.startswith(HOST_FILE_SENDER_STATUS):
+            yield line[len(HOST_FILE_SENDER_STATUS):]
+        elif line.startswith(INSTRUMENTATION_STATUS_CODE):
+            if line[len(INSTRUMENTATION_STATUS_CODE):].strip() == TEST_FAILED_STATUS_CODE:
+                failed_tests += 1
+        elif line.startswith(("INSTRUMENTATION_RESULT", "INSTRUMENTATION_CODE", "INSTRUMENTATION_FAILED")):
+            print(line)
+            if line.startswith("INSTRUMENTATION_FAILED"):
+                failure = line
+            elif line.startswith(INSTRUMENTATION_CODE):
+                code = line[len(INSTRUMENTATION_CODE):].strip()
+
+    if failure:
+        raise RuntimeError("The instrumentation failed: %s" % failure)
+    if code is None:
+        raise RuntimeError("The instrumentation did not finish, the app might have crashed")
+    if code != INSTRUMENTATION_OK_CODE:
+        raise RuntimeError("The instrumentation finished with code %s" % code)
+    if failed_tests:
+        raise RuntimeError("%d tests failed" % failed_tests)
+
+def pull_during_instrumentation(component, dir, adb_puller, jobs=1, instrument_args={}):
+    """Runs the instrumentation given by component (e.g.
+    com.foo.tests/android.support.test.runner.AndroidJUnitRunner) and
+    pulls every file that HostFileSender announces into dir while the
+    tests are still running, deleting it on the device afterwards.
+    Returns a list of (file, error) for the files that could not be
+    pulled. Raises a RuntimeError once every announced file is pulled
+    if the instrumentation or any of its tests failed."""
+    args = dict(instrument_args)
+    args['HostFileSender_supported'] = 'true'
+
+    def receive(src):
+        error = _pull_file(adb_puller, src, join(dir, os.path.basename(src)))
+        try:
+            # delete it even if we could not pull it, since the test
+            # blocks once HostFileSender has too many pending files
+            adb_puller.remove(src)
+        except (subprocess.CalledProcessError, OSError) as e:
+            error = error or e
+        return src, error
+
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        pending = [pool.apply_async(receive, (src,))
+                   for src in _host_sender_files(adb_puller.instrument(component, args))]
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = [(src, error) for src, error in (p.get() for p in pending) if error is not None]
+    for src, error in failures:
+        print("Could not pull %s: %s" % (src, error), file=sys.stderr)
+    return failures
+
+def pull_sharded(package, dir, adb_pullers, filter_name_regex=None, jobs=1, screenshot_filter=None):
+    """Pulls the screenshots from several devices (e.g. when the tests
+    are sharded across emulators) in parallel, and merges them into
+    dir as if they came from a single device"""
+    shard_dirs = [tempfile.mkdtemp(prefix='shard', dir=dir) for puller in adb_pullers]
+
+    def pull(args):
+        shard_dir, adb_puller = args
+        return pull_filtered(package,
+                             shard_dir,
+                             adb_puller=adb_puller,
+                             filter_name_regex=filter_name_regex,
+                             jobs=jobs,
+                             screenshot_filter=screenshot_filter)
 
-def _validate_metadata(dir):
     try:
-        ET.parse(join(dir, 'metadata.xml'))
-    except ET.ParseError as e:
-        raise RuntimeError("Unable to parse metadata file, this commonly happens if you did not call ScreenshotRunner.onDestroy() from your instrumentation")
+        pool = ThreadPool(len(adb_pullers))
+        try:
+            results = pool.map(pull, list(zip(shard_dirs, adb_pullers)))
+        finally:
+            pool.close()
+            pool.join()
+
+        metadata.merge_metadata([join(d, 'metadata.xml') for d in shard_dirs],
+                                join(dir, 'metadata.xml'))
+        for shard_dir in shard_dirs:
+            for f in os.listdir(shard_dir):
+                if f != 'metadata.xml':
+                    shutil.move(join(shard_dir, f), join(dir, f))
+    finally:
+        for shard_dir in shard_dirs:
+            shutil.rmtree(shard_dir)
+
+    return [failure for failures in results for failure in failures]
+
+def _close_pullers(adb_puller):
+    """Closes the connections of the pullers that keep any open (like
+    SyncPuller's sync sessions)"""
+    for puller in adb_puller if isinstance(adb_puller, list) else [adb_puller]:
+        if hasattr(puller, "close"):
+            puller.close()
+
+def _summary(dir, index=None):
+    if index is None:
+        index = _load_index(dir)
+    print("Found %d screenshots" % len(index))
+
+def _load_index(dir):
+    try:
+        return metadata.ScreenshotIndex.load(join(dir, 'metadata.xml'))
+    except ET.ParseError:
+        raise RuntimeError(METADATA_PARSE_ERROR)
 
 def pull_screenshots(process,
                      adb_puller,
@@ -243,7 +593,19 @@ def pull_screenshots(process,
                      filter_name_regex=None,
                      record=None,
                      verify=None,
-                     opt_generate_png=None):
+                     opt_generate_png=None,
+                     pull_jobs=1,
+                     incremental_pull=False,
+                     instrumentation=None,
+                     jobs=1,
+                     comparator=None,
+                     screenshot_filter=None,
+                     thumbnails=False,
+                     thumbnail_cache=None,
+                     golden_layout=None,
+                     incremental_record=False,
+                     golden_png_profile=None,
+                     report_png_profile=None):
 
     if not perform_pull and temp_dir is None:
         raise RuntimeError("""You must supply a directory for temp_dir if --no-pull is present""")
@@ -251,44 +613,134 @@ def pull_screenshots(process,
     temp_dir = temp_dir or tempfile.mkdtemp(prefix='screenshots')
 
     copy_assets(temp_dir)
+    _clean_verify_results(temp_dir)
 
-    if perform_pull is True:
-        pull_filtered(process, adb_puller=adb_puller, dir=temp_dir, filter_name_regex=filter_name_regex)
-
-    _validate_metadata(temp_dir)
+    if instrumentation and (not perform_pull or isinstance(adb_puller, list)):
+        raise RuntimeError("--instrument requires pulling from a single device")
 
-    path_to_html = generate_html(temp_dir)
+    index = None
+    failures = []
+    if perform_pull is True:
+        try:
+            streaming_failures = []
+            if instrumentation:
+                streaming_failures = pull_during_instrumentation(instrumentation,
+                                                                 temp_dir,
+                                                                 adb_puller=adb_puller,
+                                                                 jobs=pull_jobs)
+
+            if isinstance(adb_puller, list):
+                failures = pull_sharded(process,
+                                        adb_pullers=adb_puller,
+                                        dir=temp_dir,
+                                        filter_name_regex=filter_name_regex,
+                                        jobs=pull_jobs,
+                                        screenshot_filter=screenshot_filter)
+            else:
+                index, failures = _pull_filtered(process,
+                                                 adb_puller=adb_puller,
+                                                 dir=temp_dir,
+                                                 filter_name_regex=filter_name_regex,
+                                                 jobs=pull_jobs,
+                                                 incremental=incremental_pull,
+                                                 only_missing=bool(instrumentation),
+                                                 screenshot_filter=screenshot_filter)
+            failures = streaming_failures + failures
+            if failures:
+                print("Failed to pull %d files, see above for details" % len(failures),
+                      file=sys.stderr)
+        finally:
+            _close_pullers(adb_puller)
+
+    if index is None:
+        index = _load_index(temp_dir)
+
+    # the PNG profiles default to the ones in golden_store, which can't be
+    # imported before we know that PIL is needed
+    if thumbnails or record or verify:
+        from .golden_store import GOLDEN_PNG_PROFILE, REPORT_PNG_PROFILE, check_png_profile
+        golden_png_profile = golden_png_profile or GOLDEN_PNG_PROFILE
+        report_png_profile = report_png_profile or REPORT_PNG_PROFILE
+        check_png_profile(golden_png_profile)
+        check_png_profile(report_png_profile)
+
+    thumbnail_files = {}
+    if thumbnails:
+        # don't import this early, since we need PIL to import this
+        from .thumbnails import generate_thumbnails
+        thumbnail_files = generate_thumbnails(temp_dir, index, cache_dir=thumbnail_cache, jobs=jobs,
+                                              png_profile=report_png_profile)
 
     if record or verify:
         # don't import this early, since we need PIL to import this
-        from .recorder import Recorder
-        recorder = Recorder(temp_dir, record or verify)
+        from .recorder import Recorder, VerifyError
+        from .golden_store import open_store
+        recorder = Recorder(temp_dir, record or verify, jobs=jobs, comparator=comparator, index=index,
+                            store=open_store(record or verify, golden_layout, golden_png_profile),
+                            report_png_profile=report_png_profile)
         if verify:
-            recorder.verify()
+            try:
+                recorder.verify()
+            except VerifyError:
+                # still generate the report, which links the diffs
+                print("See file://%s for the differences"
+                      % generate_html(temp_dir, index, thumbnail_files, paginate=not opt_generate_png),
+                      file=sys.stderr)
+                raise
+        elif incremental_record:
+            summary = recorder.record_incremental()
+            print("Recorded %d changed, %d added and %d removed screenshots" % (
+                len(summary["changed"]), len(summary["added"]), len(summary["removed"])))
+            for status in ["changed", "added", "removed"]:
+                for name in summary[status]:
+                    print("  %s: %s" % (status, name))
         else:
             recorder.record()
 
+    # the PNG is rendered from index.html alone, so it has to show every
+    # screenshot
+    path_to_html = generate_html(temp_dir, index, thumbnail_files, paginate=not opt_generate_png)
+
     if opt_generate_png:
         generate_png(path_to_html, opt_generate_png)
         shutil.rmtree(temp_dir)
     else:
         print("\n\n")
-        _summary(temp_dir)
+        _summary(temp_dir, index)
         print('Open the following url in a browser to view the results: ')
         print('  file://%s' % path_to_html)
         print("\n\n")
 
+    # the report shows what could be pulled, but the run still failed
+    return 1 if failures else 0
+
 def setup_paths():
     android_home = common.get_android_sdk()
     os.environ['PATH'] = os.environ['PATH'] + ":" + android_home + "/platform-tools/"
 
+def _filter_options(opt_list, opt):
+    """Collects the FIELD:REGEX values of the given option into the
+    include/exclude map of a ScreenshotFilter"""
+    filters = {}
+    for name, value in opt_list:
+        if name == opt:
+            field, sep, regex = value.partition(':')
+            if not sep or field not in metadata.FILTER_FIELDS:
+                raise ValueError("Expected FIELD:REGEX for %s, got %s" % (opt, value))
+            filters.setdefault(field, []).append(regex)
+    return filters
+
 def main(argv):
     setup_paths()
     try:
         opt_list, rest_args = getopt.gnu_getopt(
             argv[1:],
             "eds:",
-            ["generate-png=", "filter-name-regex=", "apk", "record=", "verify=", "temp-dir=", "no-pull"])
+            ["generate-png=", "filter-name-regex=", "apk", "record=", "verify=", "temp-dir=", "no-pull",
+             "pull-jobs=", "persistent-adb", "incremental-pull", "instrument=", "jobs=",
+             "channel-tolerance=", "max-diff-ratio=", "min-ssim=", "include=", "exclude=",
+             "only-failed=", "thumbnails", "thumbnail-cache=", "golden-layout=",
+             "incremental-record", "golden-png=", "report-png="])
     except getopt.GetoptError as err:
         usage()
         return 2
@@ -301,6 +753,41 @@ def main(argv):
 
     opts = dict(opt_list)
 
+    try:
+        pull_jobs = int(opts.get('--pull-jobs', 1))
+        jobs = int(opts.get('--jobs', 1))
+        channel_tolerance = int(opts.get('--channel-tolerance', 0))
+        max_diff_ratio = float(opts.get('--max-diff-ratio', 0))
+        min_ssim = float(opts['--min-ssim']) if '--min-ssim' in opts else None
+        # --only-failed selects the screenshots that failed the verify
+        # that wrote the given report
+        screenshot_filter = metadata.ScreenshotFilter(
+            include=_filter_options(opt_list, '--include'),
+            exclude=_filter_options(opt_list, '--exclude'),
+            names=read_verify_failures(opts['--only-failed']) if '--only-failed' in opts else None)
+        if '--golden-png' in opts or '--report-png' in opts or '--golden-layout' in opts:
+            # don't import this unless needed, since we need PIL for this
+            from .golden_store import check_layout, check_png_profile
+            for opt in ['--golden-png', '--report-png']:
+                if opt in opts:
+                    check_png_profile(opts[opt])
+            if '--golden-layout' in opts:
+                check_layout(opts['--golden-layout'])
+    except (ValueError, re.error):
+        usage()
+        return 2
+
+    if min_ssim is not None and max_diff_ratio:
+        # the SSIM replaces the ratio of differing pixels
+        usage()
+        return 2
+
+    comparator = None
+    if channel_tolerance or max_diff_ratio or min_ssim is not None:
+        # don't import this early, since we need PIL and numpy for this
+        from .compare import get_comparator
+        comparator = get_comparator(channel_tolerance, max_diff_ratio, min_ssim)
+
     if "--apk" in opts:
         # treat process as an apk instead
         process = aapt.get_package(process)
@@ -314,8 +801,17 @@ def main(argv):
     if "-d" in opts:
         puller_args.append("-d")
 
-    if "-s" in opts:
-        puller_args += ["-s", opts["-s"]]
+    # --persistent-adb talks to the adb server over a single long-lived
+    # connection instead of spawning adb for every file
+    puller_class = SyncPuller if "--persistent-adb" in opts else SimplePuller
+
+    # -s may be given several times to pull from every device the
+    # tests were sharded across
+    serials = [value for opt, value in opt_list if opt == "-s"]
+    if len(serials) > 1:
+        adb_puller = [puller_class(puller_args + ["-s", serial]) for serial in serials]
+    else:
+        adb_puller = puller_class(puller_args + ["-s", serials[0]] if serials else puller_args)
 
     return pull_screenshots(process,
                             perform_pull=should_perform_pull,
@@ -324,7 +820,19 @@ def main(argv):
                             opt_generate_png=opts.get('--generate-png'),
                             record=opts.get('--record'),
                             verify=opts.get('--verify'),
-                            adb_puller=SimplePuller(puller_args))
+                            pull_jobs=pull_jobs,
+                            incremental_pull=("--incremental-pull" in opts),
+                            instrumentation=opts.get('--instrument'),
+                            jobs=jobs,
+                            comparator=comparator,
+                            screenshot_filter=screenshot_filter,
+                            thumbnails=("--thumbnails" in opts),
+                            thumbnail_cache=opts.get('--thumbnail-cache'),
+                            golden_layout=opts.get('--golden-layout'),
+                            incremental_record=("--incremental-record" in opts),
+                            golden_png_profile=opts.get('--golden-png'),
+                            report_png_profile=opts.get('--report-png'),
+                            adb_puller=adb_puller)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -8,98 +8,311 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 #
 
-import xml.etree.ElementTree as ET
+import json
+import multiprocessing
 import os
 import sys
 
 from os.path import join
-from PIL import Image, ImageChops
+from PIL import Image
 
 from . import common
+from . import metadata
+from .golden_store import REPORT_PNG_PROFILE, open_store, pixel_hash, save_png
+from .compare import ExactComparator
 import shutil
-import tempfile
+
+# Written into the input directory by verify, with the details of every
+# screenshot that did not match
+VERIFY_REPORT = "verify_report.json"
+
+# Subdirectory of the input directory where verify writes the actual
+# image, the diff and the side by side composite of every failure
+VERIFY_FAILURES = "verify_failures"
+
+# How much the unchanged pixels are faded towards white in diff images,
+# so that the highlighted ones stand out
+DIFF_FADE = 0.7
+DIFF_HIGHLIGHT = (255, 0, 0, 255)
 
 class VerifyError(Exception):
-    pass
+    def __init__(self, message, failures=[]):
+        Exception.__init__(self, message)
+        self.failures = failures
 
-class Recorder:
-    def __init__(self, input, output):
-        self._input = input
-        self._output = output
-        self._realoutput = output
+def _stitch(input, name, w, h):
+    """Stitches the tiles of a single screenshot into one in-memory
+    image. Every tile is opened once: opening only reads its header,
+    which is enough to lay out the canvas, and the pixels are decoded when
+    it's pasted. Columns take the widths of the tiles in the first row,
+    and rows the heights of the tiles in the first column, so a smaller
+    last tile is placed right after the ones before it."""
+    tiles = []
+    try:
+        for j in range(h):
+            row = []
+            tiles.append(row)
+            for i in range(w):
+                row.append(Image.open(join(input, common.get_image_file_name(name, i, j))))
 
-    def _get_image_size(self, file_name):
-        with Image.open(file_name) as im:
-            return im.size
+        lefts = [0]
+        for tile in tiles[0]:
+            lefts.append(lefts[-1] + tile.size[0])
+        tops = [0]
+        for row in tiles:
+            tops.append(tops[-1] + row[0].size[1])
 
-    def _copy(self, name, w, h):
-        tilewidth, tileheight = self._get_image_size(
-            join(self._input,
-                 common.get_image_file_name(name, 0, 0)))
+        im = Image.new("RGBA", (lefts[-1], tops[-1]))
+        for j, row in enumerate(tiles):
+            for i, tile in enumerate(row):
+                im.paste(tile, (lefts[i], tops[j]))
+        return im
+    finally:
+        for row in tiles:
+            for tile in row:
+                tile.close()
 
-        canvaswidth = 0
+def _copy(args):
+    """Stitches a single screenshot and puts it in the golden store.
+    Returns its entry for the manifest."""
+    input, store, name, w, h = args
+    im = _stitch(input, name, w, h)
+    try:
+        return store.put(name, im)
+    finally:
+        im.close()
 
-        for i  in range(w):
-            input_file = common.get_image_file_name(name, i, 0)
-            canvaswidth += self._get_image_size(join(self._input, input_file))[0]
+def _update(args):
+    """Stitches a single screenshot and puts it in the golden store only if
+    it differs from the recorded one. Returns its entry for the manifest
+    and whether it was "unchanged", "changed" or "added"."""
+    input, store, name, w, h, manifest_entry = args
+    im = _stitch(input, name, w, h)
+    try:
+        if not store.exists(name, manifest_entry):
+            return store.put(name, im), "added"
 
+        hash = pixel_hash(im)
+        if manifest_entry is not None and store.is_current(name, manifest_entry):
+            if hash == manifest_entry["hash"]:
+                return manifest_entry, "unchanged"
+            return store.put(name, im), "changed"
 
-        canvasheight = 0
+        # a golden recorded before there was a manifest, or changed since,
+        # is compared by its pixels, and left as it is if they're the same
+        with store.open(name, manifest_entry) as expected:
+            if pixel_hash(expected) == hash:
+                return store.entry_for(name, hash), "unchanged"
+        return store.put(name, im), "changed"
+    finally:
+        im.close()
 
-        for j in range(h):
-            input_file = common.get_image_file_name(name, 0, j)
-            canvasheight += self._get_image_size(join(self._input, input_file))[1]
+def _diff_image(actual, mask):
+    """Fades the actual image and paints the pixels in mask over it"""
+    actual = actual.convert("RGBA")
+    diff = Image.blend(actual, Image.new("RGBA", actual.size, (255, 255, 255, 255)), DIFF_FADE)
+    diff.paste(DIFF_HIGHLIGHT, mask=mask)
+    return diff
 
-        im = Image.new("RGBA", (canvaswidth, canvasheight))
+def _composite_image(images):
+    """Puts the given images side by side, left to right"""
+    composite = Image.new("RGBA",
+                          (sum(im.size[0] for im in images), max(im.size[1] for im in images)),
+                          (255, 255, 255, 0))
+    x = 0
+    for im in images:
+        composite.paste(im, (x, 0))
+        x += im.size[0]
+    return composite
 
-        for i in range(w):
-            for j in range(h):
-                input_file = common.get_image_file_name(name, i, j)
-                with Image.open(join(self._input, input_file)) as input_image:
-                    im.paste(input_image, (i * tilewidth, j * tileheight))
-                    input_image.close()
+def _write_failure_images(failure_dir, name, expected, actual, mask, png_profile):
+    """Writes the diff and the expected/actual/diff composite for a
+    failure, from the images that were just compared. Returns their
+    paths (None for the images that could not be made)."""
+    images = {"diff": None, "composite": None}
+    if expected is None:
+        return images
 
-        im.save(join(self._output, name + ".png"))
-        im.close()
+    composite = [expected, actual]
+    if mask is not None:
+        diff = _diff_image(actual, mask)
+        images["diff"] = join(failure_dir, name + "_diff.png")
+        save_png(diff, images["diff"], png_profile)
+        composite.append(diff)
+
+    images["composite"] = join(failure_dir, name + "_composite.png")
+    save_png(_composite_image(composite), images["composite"], png_profile)
+    return images
+
+def _verify(args):
+    """Stitches a single screenshot in memory and compares it with the
+    recorded one. Returns None if they are the same, or a description of
+    the failure otherwise. The stitched image, and the diff images, are
+    only written (to failure_dir) if it differs."""
+    input, store, failure_dir, name, w, h, manifest_entry, comparator, png_profile = args
+    actual = _stitch(input, name, w, h)
+    try:
+        actual_file = join(failure_dir, name + ".png")
+        failure = {"name": name,
+                   "expected": store.location(name, manifest_entry),
+                   "actual": actual_file,
+                   "actual_size": list(actual.size)}
+
+        if not store.exists(name, manifest_entry):
+            failure.update({"reason": "missing", "bbox": None, "differing_pixels": None})
+            failure.update(_write_failure_images(failure_dir, name, None, actual, None, png_profile))
+        else:
+            # If the golden still is the one the manifest was written for,
+            # comparing hashes saves us from decoding it
+            if (manifest_entry is not None
+                and pixel_hash(actual) == manifest_entry["hash"]
+                and store.is_current(name, manifest_entry)):
+                return None
+
+            with store.open(name, manifest_entry) as expected:
+                difference = comparator(expected, actual)
+                if difference is None:
+                    return None
+                mask = difference.pop("mask", None)
+                failure.update(difference)
+                failure["expected_size"] = list(expected.size)
+                failure.update(_write_failure_images(failure_dir, name, expected, actual, mask, png_profile))
+
+        save_png(actual, actual_file, png_profile)
+        return failure
+    finally:
+        actual.close()
+
+def parallel_map(func, items, jobs):
+    """Returns [func(item) for item in items], spreading the work over a
+    pool of jobs worker processes when there is more than one job. The
+    results are in the order of items, and the exception of the first
+    item that fails (in that order) is raised. func and the items are
+    pickled to reach the workers, so func has to be a module level
+    function, taking all it needs in its single argument."""
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
 
-    def _get_metadata_root(self):
-        return ET.parse(join(self._input, "metadata.xml")).getroot()
+    pool = multiprocessing.Pool(min(jobs, len(items)))
+    try:
+        return list(pool.imap(func, items))
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _describe_failure(failure):
+    if failure["reason"] == "missing":
+        problem = "no recorded screenshot"
+    elif failure["reason"] == "size":
+        problem = "size is %dx%d instead of %dx%d" % tuple(failure["actual_size"] + failure["expected_size"])
+    else:
+        problem = "%d pixels differ in %s" % (failure["differing_pixels"], tuple(failure["bbox"]))
+
+    return "%s: %s\n    expected: %s\n    actual: %s" % (
+        failure["name"], problem, failure["expected"] or "(not recorded)", failure["actual"])
+
+class Recorder:
+    def __init__(self, input, output, jobs=1, comparator=None, index=None, store=None,
+                 report_png_profile=REPORT_PNG_PROFILE):
+        self._input = input
+        self._output = output
+        self._store = store or open_store(output)
+        self._jobs = jobs
+        self._comparator = comparator or ExactComparator()
+        self._index = index
+        self._report_png_profile = report_png_profile
+
+    def _map(self, func, items):
+        return parallel_map(func, items, self._jobs)
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = metadata.ScreenshotIndex.load(join(self._input, "metadata.xml"))
+        return self._index
+
+    def _get_screenshots(self):
+        """Returns (name, tile_width, tile_height) of every screenshot that
+        has tiles, i.e. that did not fail on the device"""
+        return [(screenshot.name, screenshot.tile_width, screenshot.tile_height)
+                for screenshot in self._get_index()
+                if screenshot.error is None]
 
     def _record(self):
-        root = self._get_metadata_root()
-        for screenshot in root.iter("screenshot"):
-            self._copy(screenshot.find('name').text,
-                       int(screenshot.find('tile_width').text),
-                       int(screenshot.find('tile_height').text))
+        screenshots = self._get_screenshots()
+        entries = self._map(_copy, [(self._input, self._store, name, w, h)
+                                    for name, w, h in screenshots])
+        self._store.commit(dict((name, entry) for (name, w, h), entry in zip(screenshots, entries)))
 
     def _clean(self):
-        if os.path.exists(self._output):
-            shutil.rmtree(self._output)
-        os.mkdir(self._output)
-
-    def _is_image_same(self, file1, file2):
-        with Image.open(file1) as im1, Image.open(file2) as im2:
-            diff_image = ImageChops.difference(im1, im2)
-            try:
-                return diff_image.getbbox() is None
-            finally:
-                diff_image.close()
+        self._store.clean()
+
+    def _clean_verify_results(self):
+        """Removes the results of an earlier verify of the same input,
+        which would be stale once the screenshots are recorded again"""
+        if os.path.exists(join(self._input, VERIFY_REPORT)):
+            os.unlink(join(self._input, VERIFY_REPORT))
+        if os.path.exists(join(self._input, VERIFY_FAILURES)):
+            shutil.rmtree(join(self._input, VERIFY_FAILURES))
 
     def record(self):
         self._clean()
+        self._clean_verify_results()
         self._record()
 
+    def record_incremental(self):
+        """Records the screenshots like record(), but leaves the goldens
+        that didn't change untouched: only new and changed screenshots are
+        written, and only the goldens of screenshots that are gone are
+        removed. Returns the names of the screenshots that were "changed",
+        "added" and "removed"."""
+        self._clean_verify_results()
+        self._store.prepare()
+        manifest = self._store.read_manifest()
+        screenshots = self._get_screenshots()
+        results = self._map(_update, [(self._input, self._store, name, w, h, manifest.get(name))
+                                      for name, w, h in screenshots])
+
+        summary = {"changed": [], "added": [], "removed": []}
+        entries = {}
+        for (name, w, h), (entry, status) in zip(screenshots, results):
+            entries[name] = entry
+            if status != "unchanged":
+                summary[status].append(name)
+
+        for name in self._store.names():
+            if name not in entries:
+                self._store.remove(name, manifest.get(name))
+                summary["removed"].append(name)
+
+        if entries != manifest:
+            self._store.commit(entries)
+        return summary
+
+    def _failure_dir(self):
+        failure_dir = join(self._input, VERIFY_FAILURES)
+        if os.path.exists(failure_dir):
+            shutil.rmtree(failure_dir)
+        os.mkdir(failure_dir)
+        return failure_dir
+
     def verify(self):
-        self._output = tempfile.mkdtemp()
-        self._record()
+        failure_dir = self._failure_dir()
+        screenshots = self._get_screenshots()
+        manifest = self._store.read_manifest()
+        results = self._map(_verify, [(self._input, self._store, failure_dir, name, w, h,
+                                       manifest.get(name), self._comparator, self._report_png_profile)
+                                      for name, w, h in screenshots])
+        failures = [failure for failure in results if failure is not None]
+
+        report_file = join(self._input, VERIFY_REPORT)
+        with open(report_file, "w") as f:
+            json.dump({"screenshots": len(screenshots), "failures": failures}, f, indent=1, sort_keys=True)
 
-        root = self._get_metadata_root()
-        for screenshot in root.iter("screenshot"):
-            name = screenshot.find('name').text + ".png"
-            actual = join(self._output, name)
-            expected = join(self._realoutput, name)
-            if not self._is_image_same(expected,
-                                       actual):
-                raise VerifyError("Image %s is not same as %s" % (actual, expected))
+        if failures:
+            raise VerifyError(
+                "%d of %d screenshots did not match (details in %s):\n%s" % (
+                    len(failures), len(screenshots), report_file,
+                    "\n".join(_describe_failure(failure) for failure in failures)),
+                failures)
 
-        shutil.rmtree(self._output)
+        shutil.rmtree(failure_dir)
@@ -22,19 +22,60 @@ class SimplePuller:
 
     def __init__(self, adb_args=[]):
         self._adb_args = list(adb_args)
+        self._adb = None
+
+    def _adb_command(self, args):
+        # resolve adb once instead of on every command
+        if self._adb is None:
+            self._adb = get_adb()
+        return [self._adb] + self._adb_args + args
 
     def remote_file_exists(self, src):
         output = common.check_output(
-            [get_adb()] + self._adb_args + ["shell",
-                                        "test -e %s && echo EXISTS" % src])
+            self._adb_command(["shell", "test -e %s && echo EXISTS" % src]))
         return "EXISTS" in output
 
     def pull(self, src, dest):
         subprocess.check_call(
-            [get_adb()] + self._adb_args + ["pull", src, dest],
+            self._adb_command(["pull", src, dest]),
+            stderr=subprocess.STDOUT)
+
+    def pull_dir(self, src, dest):
+        """Pulls the contents of the remote directory src into dest with
+        a single adb invocation. dest must not exist yet, so that all
+        adb versions agree on where the files end up."""
+        subprocess.check_call(
+            self._adb_command(["pull", src, dest]),
+            stderr=subprocess.STDOUT)
+
+    def remote_checksums(self, src):
+        """Returns the md5 checksums of all the files in the remote
+        directory src, computed on the device with one command"""
+        output = common.check_output(
+            self._adb_command(["shell", common.md5sum_command(src)]))
+        return common.parse_md5sum_output(output)
+
+    def remove(self, src):
+        subprocess.check_call(
+            self._adb_command(["shell", "rm", "-f", src]),
             stderr=subprocess.STDOUT)
 
+    def instrument(self, component, args={}):
+        """Runs the instrumentation with raw status output, and yields its
+        output line by line while it runs"""
+        command = ["shell", "am", "instrument", "-r", "-w"]
+        for key, value in sorted(args.items()):
+            command += ["-e", key, value]
+        process = subprocess.Popen(
+            self._adb_command(command + [component]),
+            stdout=subprocess.PIPE)
+        for line in iter(process.stdout.readline, b''):
+            yield line.decode('utf-8')
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
     def get_external_data_dir(self):
         output = common.check_output(
-            [get_adb()] + self._adb_args + ["shell", "echo", "$EXTERNAL_STORAGE"])
+            self._adb_command(["shell", "echo", "$EXTERNAL_STORAGE"]))
         return output.strip().split()[-1]
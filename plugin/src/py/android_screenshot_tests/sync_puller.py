@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import os
+import socket
+import stat
+import struct
+import subprocess
+import threading
+
+from . import common
+from .common import get_adb
+
+DEFAULT_ADB_SERVER_PORT = 5037
+
+class AdbError(OSError):
+    pass
+
+class SyncPuller:
+    """Pulls files from the device by talking to the adb server directly.
+
+    Unlike SimplePuller, which spawns an adb process for every command,
+    this keeps one sync session with the adb server open per thread and
+    reuses it for every pull and existence check."""
+
+    def __init__(self, adb_args=[], host='127.0.0.1', port=None):
+        self._adb_args = list(adb_args)
+        self._host = host
+        self._port = port or int(os.environ.get('ANDROID_ADB_SERVER_PORT',
+                                                DEFAULT_ADB_SERVER_PORT))
+        self._transport = self._get_transport(self._adb_args)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._external_data_dir = None
+        self._started_server = False
+
+    def _get_transport(self, adb_args):
+        """Translates adb's device selection flags into the matching host
+        service, the same way the adb client does"""
+        if "-s" in adb_args:
+            return "host:transport:" + adb_args[adb_args.index("-s") + 1]
+        if "-d" in adb_args:
+            return "host:transport-usb"
+        if "-e" in adb_args:
+            return "host:transport-local"
+        if os.environ.get('ANDROID_SERIAL'):
+            return "host:transport:" + os.environ['ANDROID_SERIAL']
+        return "host:transport-any"
+
+    def _connect(self):
+        try:
+            return socket.create_connection((self._host, self._port))
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED or self._started_server:
+                raise
+            self._started_server = True
+            subprocess.check_call([get_adb(), "start-server"])
+            return socket.create_connection((self._host, self._port))
+
+    def _open_service(self, service):
+        """Opens a new connection to the device, and starts the given
+        service (e.g. "sync:" or "shell:...") on it"""
+        sock = self._connect()
+        try:
+            self._send_request(sock, self._transport)
+            self._send_request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _send_request(self, sock, request):
+        request = request.encode('utf-8')
+        sock.sendall(("%04x" % len(request)).encode('ascii') + request)
+        status = _recv_exactly(sock, 4)
+        if status == b"FAIL":
+            length = int(_recv_exactly(sock, 4), 16)
+            raise AdbError("adb server refused %s: %s" % (
+                request.decode('utf-8'),
+                _recv_exactly(sock, length).decode('utf-8', 'replace')))
+        if status != b"OKAY":
+            raise AdbError("unexpected response from adb server: %r" % status)
+
+    def _sync(self):
+        """Returns the sync connection for the current thread, creating it
+        on first use"""
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = self._open_service("sync:")
+            self._local.sock = sock
+            with self._lock:
+                self._connections.append(sock)
+        return sock
+
+    def _drop_sync(self):
+        """Forgets the current thread's sync connection after an error
+        that may have left it in an inconsistent state"""
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            self._local.sock = None
+            with self._lock:
+                self._connections.remove(sock)
+            sock.close()
+
+    def _sync_command(self, command, path):
+        sock = self._sync()
+        path = path.encode('utf-8')
+        try:
+            sock.sendall(command + struct.pack("<I", len(path)) + path)
+        except Exception:
+            self._drop_sync()
+            raise
+        return sock
+
+    def _stat(self, path):
+        sock = self._sync_command(b"STAT", path)
+        try:
+            response = _recv_exactly(sock, 16)
+            if response[:4] != b"STAT":
+                raise AdbError("unexpected sync response: %r" % response[:4])
+        except Exception:
+            self._drop_sync()
+            raise
+        return struct.unpack("<III", response[4:])
+
+    def _list(self, path):
+        sock = self._sync_command(b"LIST", path)
+        entries = []
+        try:
+            while True:
+                header = _recv_exactly(sock, 20)
+                if header[:4] == b"DONE":
+                    return entries
+                if header[:4] != b"DENT":
+                    raise AdbError("unexpected sync response: %r" % header[:4])
+                mode, size, mtime, namelen = struct.unpack("<IIII", header[4:])
+                name = _recv_exactly(sock, namelen).decode('utf-8')
+                if name not in (".", ".."):
+                    entries.append((name, mode))
+        except Exception:
+            self._drop_sync()
+            raise
+
+    def remote_file_exists(self, src):
+        mode, size, mtime = self._stat(src)
+        return mode != 0
+
+    def pull(self, src, dest):
+        sock = self._sync_command(b"RECV", src)
+        try:
+            with open(dest, 'wb') as out:
+                while True:
+                    header = _recv_exactly(sock, 8)
+                    length = struct.unpack("<I", header[4:])[0]
+                    if header[:4] == b"DATA":
+                        out.write(_recv_exactly(sock, length))
+                    elif header[:4] == b"DONE":
+                        return
+                    elif header[:4] == b"FAIL":
+                        message = _recv_exactly(sock, length).decode('utf-8', 'replace')
+                        raise AdbError("could not pull %s: %s" % (src, message))
+                    else:
+                        raise AdbError("unexpected sync response: %r" % header[:4])
+        except Exception:
+            # the device closes the sync session after a failed transfer
+            self._drop_sync()
+            raise
+
+    def pull_dir(self, src, dest):
+        """Pulls the contents of the remote directory src into dest,
+        listing and transferring all of it over the same session"""
+        os.makedirs(dest)
+        for name, mode in self._list(src):
+            remote = src.rstrip("/") + "/" + name
+            if stat.S_ISDIR(mode):
+                self.pull_dir(remote, os.path.join(dest, name))
+            elif stat.S_ISREG(mode):
+                self.pull(remote, os.path.join(dest, name))
+
+    def shell(self, command):
+        """Runs a shell command on the device and returns its output"""
+        return "".join(self.shell_lines(command))
+
+    def shell_lines(self, command):
+        """Runs a shell command on the device and yields its output line
+        by line while it runs"""
+        sock = self._open_service("shell:" + command)
+        try:
+            stream = sock.makefile('rb')
+            for line in iter(stream.readline, b''):
+                yield line.decode('utf-8')
+            stream.close()
+        finally:
+            sock.close()
+
+    def remove(self, src):
+        self.shell("rm -f " + src)
+
+    def instrument(self, component, args={}):
+        """Runs the instrumentation with raw status output, and yields its
+        output line by line while it runs"""
+        command = "am instrument -r -w"
+        for key, value in sorted(args.items()):
+            command += " -e %s %s" % (key, value)
+        return self.shell_lines(command + " " + component)
+
+    def remote_checksums(self, src):
+        """Returns the md5 checksums of all the files in the remote
+        directory src, computed on the device with one command"""
+        return common.parse_md5sum_output(self.shell(common.md5sum_command(src)))
+
+    def get_external_data_dir(self):
+        if self._external_data_dir is None:
+            output = self.shell("echo $EXTERNAL_STORAGE")
+            self._external_data_dir = output.strip().split()[-1]
+        return self._external_data_dir
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for sock in connections:
+            try:
+                sock.sendall(b"QUIT" + struct.pack("<I", 0))
+            except socket.error:
+                pass
+            sock.close()
+
+def _recv_exactly(sock, length):
+    chunks = []
+    while length > 0:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            raise AdbError("connection to adb server closed unexpectedly")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
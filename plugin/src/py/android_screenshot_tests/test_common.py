@@ -13,6 +13,7 @@ import os
 from . import common
 import subprocess
 import sys
+import tempfile
 
 class TestCommon(unittest.TestCase):
     def setUp(self):
@@ -42,3 +43,32 @@ class TestCommon(unittest.TestCase):
     def test_get_adb_can_run_in_subprocess(self):
         os.environ['ANDROID_SDK'] = self.android_sdk
         subprocess.check_call([common.get_adb(), "devices"])
+
+class TestMd5sum(unittest.TestCase):
+    def test_parse_md5sum_output(self):
+        output = """d41d8cd98f00b204e9800998ecf8427e  foo.png
+D41D8CD98F00B204E9800998ECF8427F  bar baz.xml
+md5sum: metadata.xml: Permission denied
+"""
+        self.assertEqual({"foo.png": "d41d8cd98f00b204e9800998ecf8427e",
+                          "bar baz.xml": "d41d8cd98f00b204e9800998ecf8427f"},
+                         common.parse_md5sum_output(output))
+
+    def test_parse_md5sum_output_of_find(self):
+        output = "d41d8cd98f00b204e9800998ecf8427e  ./foo.png\n"
+        self.assertEqual({"foo.png": "d41d8cd98f00b204e9800998ecf8427e"},
+                         common.parse_md5sum_output(output))
+
+    def test_md5sum_command_does_not_expand_every_file(self):
+        self.assertNotIn("*", common.md5sum_command("/sdcard/screenshots"))
+
+    def test_md5sum_not_available(self):
+        self.assertEqual({}, common.parse_md5sum_output("/system/bin/sh: md5sum: not found\n"))
+
+    def test_md5sum(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"foobar\n")
+        try:
+            self.assertEqual("14758f1afd44c09b7992073ccf00b43d", common.md5sum(f.name))
+        finally:
+            os.unlink(f.name)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+import numpy
+from PIL import Image
+
+from .compare import ExactComparator, ToleranceComparator, SsimComparator, get_comparator
+
+def make_image(size=(32, 32), color=(0, 0, 255, 255), changes={}):
+    im = Image.new("RGBA", size, color)
+    for xy, pixel in changes.items():
+        im.putpixel(xy, pixel)
+    return im
+
+class TestExactComparator(unittest.TestCase):
+    def test_same(self):
+        self.assertIsNone(ExactComparator()(make_image(), make_image()))
+
+    def test_different(self):
+        difference = ExactComparator()(make_image(), make_image(changes={(3, 4): (0, 0, 254, 255),
+                                                                         (5, 9): (0, 0, 255, 0)}))
+        self.assertEqual("pixels", difference["reason"])
+        self.assertEqual([3, 4, 6, 10], difference["bbox"])
+        self.assertEqual(2, difference["differing_pixels"])
+        self.assertEqual(255, difference["mask"].getpixel((3, 4)))
+        self.assertEqual(0, difference["mask"].getpixel((4, 4)))
+
+    def test_different_size(self):
+        difference = ExactComparator()(make_image(), make_image(size=(32, 40)))
+        self.assertEqual("size", difference["reason"])
+        self.assertEqual([0, 0, 32, 40], difference["bbox"])
+        self.assertIsNone(difference["mask"])
+
+    def test_different_mode(self):
+        self.assertIsNone(ExactComparator()(make_image().convert("RGB"), make_image()))
+
+class TestToleranceComparator(unittest.TestCase):
+    def test_within_channel_tolerance(self):
+        comparator = ToleranceComparator(channel_tolerance=2)
+        self.assertIsNone(comparator(make_image(), make_image(changes={(3, 4): (2, 0, 253, 255)})))
+
+    def test_beyond_channel_tolerance(self):
+        comparator = ToleranceComparator(channel_tolerance=2)
+        difference = comparator(make_image(), make_image(changes={(3, 4): (3, 0, 255, 255),
+                                                                  (7, 1): (1, 0, 255, 255)}))
+        self.assertEqual([3, 4, 4, 5], difference["bbox"])
+        self.assertEqual(1, difference["differing_pixels"])
+        self.assertEqual([3, 4, 4, 5], list(difference["mask"].getbbox()))
+
+    def test_channels_are_not_wrapped(self):
+        comparator = ToleranceComparator(channel_tolerance=2)
+        self.assertIsNotNone(comparator(make_image(color=(0, 0, 0, 255)),
+                                        make_image(color=(255, 0, 0, 255))))
+
+    def test_max_diff_ratio(self):
+        changes = {(0, 0): (255, 0, 0, 255), (1, 0): (255, 0, 0, 255)}
+        self.assertIsNone(ToleranceComparator(max_diff_ratio=0.002)(make_image(), make_image(changes=changes)))
+        self.assertIsNotNone(ToleranceComparator(max_diff_ratio=0.001)(make_image(), make_image(changes=changes)))
+
+    def test_different_size(self):
+        self.assertEqual("size", ToleranceComparator(max_diff_ratio=1)(make_image(), make_image(size=(1, 1)))["reason"])
+
+class TestSsimComparator(unittest.TestCase):
+    def test_identical(self):
+        array = numpy.asarray(make_image())
+        self.assertEqual(1.0, SsimComparator(0.99).ssim(array, array))
+
+    def test_small_noise_is_accepted(self):
+        changes = dict(((x, 0), (0, 0, 250, 255)) for x in range(0, 32, 4))
+        self.assertIsNone(SsimComparator(0.99)(make_image(), make_image(changes=changes)))
+
+    def test_structural_change_is_rejected(self):
+        changes = dict(((x, y), (255, 255, 255, 255)) for x in range(8, 24) for y in range(8, 24))
+        difference = SsimComparator(0.99)(make_image(), make_image(changes=changes))
+        self.assertEqual([8, 8, 24, 24], difference["bbox"])
+        self.assertEqual(256, difference["differing_pixels"])
+
+    def test_change_in_partial_edge_block_is_rejected(self):
+        # 30 pixels leave a partial block at the right and bottom edges
+        changes = dict(((x, y), (255, 255, 255, 255)) for x in range(24, 30) for y in range(24, 30))
+        self.assertIsNotNone(SsimComparator(0.99)(make_image(size=(30, 30)),
+                                                  make_image(size=(30, 30), changes=changes)))
+
+    def test_alpha_change_is_rejected(self):
+        changes = dict(((x, y), (0, 0, 255, 0)) for x in range(8, 24) for y in range(8, 24))
+        self.assertIsNotNone(SsimComparator(0.99)(make_image(), make_image(changes=changes)))
+
+    def test_image_smaller_than_block(self):
+        self.assertIsNone(SsimComparator(0.99)(make_image(size=(4, 4)), make_image(size=(4, 4))))
+        self.assertIsNotNone(SsimComparator(0.99)(make_image(size=(4, 4)),
+                                                  make_image(size=(4, 4), changes={(0, 0): (0, 0, 0, 0)})))
+
+class TestGetComparator(unittest.TestCase):
+    def test_default_is_exact(self):
+        self.assertIsInstance(get_comparator(), ExactComparator)
+
+    def test_tolerance(self):
+        comparator = get_comparator(channel_tolerance=3, max_diff_ratio=0.1)
+        self.assertIsInstance(comparator, ToleranceComparator)
+        self.assertEqual(3, comparator.channel_tolerance)
+        self.assertEqual(0.1, comparator.max_diff_ratio)
+
+    def test_ssim(self):
+        comparator = get_comparator(min_ssim=0.95)
+        self.assertIsInstance(comparator, SsimComparator)
+        self.assertEqual(0.95, comparator.min_ssim)
+
+    def test_ssim_with_max_diff_ratio(self):
+        self.assertRaises(ValueError, get_comparator, max_diff_ratio=0.1, min_ssim=0.95)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from os.path import join
+
+from PIL import Image
+
+from . import golden_store
+from .golden_store import ContentAddressedStore, DirectoryStore, PackStore, convert, open_store
+from .recorder import Recorder, VerifyError
+from .test_recorder import create_screenshots
+
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+class TestContentAddressedStore(unittest.TestCase):
+    def setUp(self):
+        self.inputdir = tempfile.mkdtemp()
+        self.goldens = join(tempfile.mkdtemp(), "goldens")
+        self.store = ContentAddressedStore(self.goldens)
+
+    def tearDown(self):
+        shutil.rmtree(self.inputdir)
+        shutil.rmtree(os.path.dirname(self.goldens))
+
+    def blobs(self):
+        return sorted(blob for shard in os.listdir(join(self.goldens, "blobs"))
+                      for blob in os.listdir(join(self.goldens, "blobs", shard)))
+
+    def test_identical_screenshots_are_stored_once(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue", "baz": "red"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+
+        manifest = self.store.read_manifest()
+        self.assertEqual(manifest["foo"], manifest["bar"])
+        self.assertNotEqual(manifest["foo"], manifest["baz"])
+        self.assertEqual(2, len(self.blobs()))
+
+    def test_blobs_are_sharded(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+
+        hash = self.store.read_manifest()["foo"]["hash"]
+        self.assertTrue(os.path.exists(join(self.goldens, "blobs", hash[:2], hash + ".png")))
+
+    def test_verify(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+
+        with patch.object(ContentAddressedStore, "open") as mock_open:
+            Recorder(self.inputdir, self.goldens).verify()
+            # unchanged screenshots only need the manifest
+            self.assertFalse(mock_open.called)
+
+        Image.new("RGBA", (10, 10), "red").save(join(self.inputdir, "bar.png"))
+        try:
+            Recorder(self.inputdir, self.goldens).verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            self.assertEqual(["bar"], [f["name"] for f in e.failures])
+            self.assertEqual(self.store.location("bar", self.store.read_manifest()["bar"]),
+                             e.failures[0]["expected"])
+
+    def test_verify_missing(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+
+        try:
+            Recorder(self.inputdir, self.goldens).verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            self.assertEqual("missing", e.failures[0]["reason"])
+            self.assertIn("expected: (not recorded)", e.args[0])
+
+    def test_gc(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+
+        self.assertEqual(2, len(self.blobs()))
+        self.assertEqual(1, self.store.gc())
+        self.assertEqual([self.store.read_manifest()["foo"]["hash"] + ".png"], self.blobs())
+        Recorder(self.inputdir, self.goldens).verify()
+
+    def test_gc_command(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+        create_screenshots(self.inputdir, {"bar": "red"})
+        Recorder(self.inputdir, self.goldens, store=self.store).record()
+
+        with patch('sys.stdout'):
+            self.assertEqual(0, golden_store.main(["golden_store", "gc", self.goldens]))
+        self.assertEqual(1, len(self.blobs()))
+
+class TestPackStore(unittest.TestCase):
+    def setUp(self):
+        self.inputdir = tempfile.mkdtemp()
+        self.outputdir = tempfile.mkdtemp()
+        self.pack = join(self.outputdir, "goldens.zip")
+        self.store = PackStore(self.pack)
+
+    def tearDown(self):
+        shutil.rmtree(self.inputdir)
+        shutil.rmtree(self.outputdir)
+
+    def test_record(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        Recorder(self.inputdir, self.pack).record()
+
+        self.assertEqual(["goldens.zip"], os.listdir(self.outputdir))
+        with zipfile.ZipFile(self.pack) as pack:
+            self.assertEqual(["bar.png", "foo.png", "hashes.json"], sorted(pack.namelist()))
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in pack.infolist()))
+        self.assertEqual(["bar", "foo"], self.store.names())
+        with self.store.open("foo", None) as im:
+            self.assertEqual((0, 0, 255, 255), im.getpixel((5, 5)))
+
+    def test_record_is_reproducible(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        Recorder(self.inputdir, self.pack).record()
+        with open(self.pack, "rb") as f:
+            first = f.read()
+        Recorder(self.inputdir, self.pack).record()
+        with open(self.pack, "rb") as f:
+            self.assertEqual(first, f.read())
+
+    def test_verify(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue"})
+        Recorder(self.inputdir, self.pack).record()
+        Recorder(self.inputdir, self.pack).verify()
+
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red", "baz": "red"})
+        try:
+            Recorder(self.inputdir, self.pack).verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            self.assertEqual({"bar": "pixels", "baz": "missing"},
+                             dict((f["name"], f["reason"]) for f in e.failures))
+
+    def test_verify_opens_the_pack_once_per_process(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue", "baz": "blue"})
+        Recorder(self.inputdir, self.pack).record()
+        create_screenshots(self.inputdir, {"foo": "red", "bar": "red", "baz": "red"})
+
+        with patch.object(golden_store.zipfile, "ZipFile", wraps=zipfile.ZipFile) as mock_zip:
+            self.assertRaises(VerifyError, Recorder(self.inputdir, self.pack).verify)
+            self.assertEqual(1, mock_zip.call_count)
+
+    def changed_colors(self, count, green):
+        return dict(("s%d" % i, (i, green, 0, 255)) for i in range(count))
+
+    def test_verify_with_jobs_decodes_goldens(self):
+        create_screenshots(self.inputdir, self.changed_colors(100, 0))
+        Recorder(self.inputdir, self.pack).record()
+        # every golden has to be decoded, in the workers
+        create_screenshots(self.inputdir, self.changed_colors(100, 1))
+
+        try:
+            Recorder(self.inputdir, self.pack, jobs=8).verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            self.assertEqual(100, len(e.failures))
+            self.assertEqual(set(["pixels"]), set(f["reason"] for f in e.failures))
+
+    def test_record_incremental_with_jobs_decodes_goldens(self):
+        create_screenshots(self.inputdir, self.changed_colors(100, 0))
+        Recorder(self.inputdir, self.pack).record()
+        # goldens that may have changed behind the manifest's back are
+        # decoded to compare them
+        with patch.object(PackStore, "is_current", return_value=False):
+            summary = Recorder(self.inputdir, self.pack, jobs=8).record_incremental()
+        self.assertEqual([], summary["changed"])
+
+    def test_record_incremental(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue", "baz": "blue"})
+        Recorder(self.inputdir, self.pack).record()
+
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        summary = Recorder(self.inputdir, self.pack).record_incremental()
+
+        self.assertEqual({"changed": ["bar"], "added": [], "removed": ["baz"]}, summary)
+        self.assertEqual(["bar", "foo"], self.store.names())
+        self.assertEqual(["goldens.zip"], os.listdir(self.outputdir))
+        Recorder(self.inputdir, self.pack).verify()
+
+    def test_convert_both_ways(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        files = join(self.outputdir, "files")
+        Recorder(self.inputdir, files).record()
+
+        self.assertEqual(2, convert(open_store(files), open_store(self.pack)))
+        Recorder(self.inputdir, self.pack).verify()
+
+        unpacked = join(self.outputdir, "unpacked")
+        with patch('sys.stdout'):
+            self.assertEqual(0, golden_store.main(["golden_store", "convert", self.pack, unpacked]))
+        self.assertEqual(["bar.png", "foo.png", "hashes.json"], sorted(os.listdir(unpacked)))
+        Recorder(self.inputdir, unpacked).verify()
+
+    def test_convert_goldens_without_manifest(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        files = join(self.outputdir, "files")
+        os.mkdir(files)
+        shutil.copy(join(self.inputdir, "foo.png"), files)
+
+        convert(DirectoryStore(files), self.store)
+        self.assertEqual(["foo"], self.store.names())
+        Recorder(self.inputdir, self.pack).verify()
+
+class TestPngProfiles(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_profiles_keep_the_pixels(self):
+        im = Image.new("RGBA", (200, 200), "white")
+        im.paste(Image.new("RGBA", (50, 50), "red"), (20, 30))
+        sizes = {}
+        for profile in golden_store.PNG_PROFILES:
+            path = join(self.dir, profile + ".png")
+            golden_store.save_png(im, path, profile)
+            sizes[profile] = os.path.getsize(path)
+            with Image.open(path) as saved:
+                self.assertEqual(golden_store.pixel_hash(im), golden_store.pixel_hash(saved))
+        self.assertLessEqual(sizes["smallest"], sizes["fastest"])
+
+    def test_store_profile(self):
+        with patch.object(golden_store, "save_png", wraps=golden_store.save_png) as mock_save:
+            DirectoryStore(self.dir).put("foo", Image.new("RGBA", (1, 1)))
+            self.assertEqual(golden_store.GOLDEN_PNG_PROFILE, mock_save.call_args[0][2])
+        self.assertEqual("fastest", open_store(self.dir, png_profile="fastest").png_profile)
+        self.assertRaises(ValueError, open_store, self.dir, png_profile="tiny")
+
+class TestOpenStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_detects_layout(self):
+        self.assertIsInstance(open_store(self.dir), DirectoryStore)
+        ContentAddressedStore(self.dir).commit({})
+        self.assertIsInstance(open_store(self.dir), ContentAddressedStore)
+        self.assertIsInstance(open_store(join(self.dir, "goldens.zip")), PackStore)
+
+    def test_explicit_layout(self):
+        self.assertIsInstance(open_store(self.dir, "content-addressed"), ContentAddressedStore)
+        self.assertRaises(ValueError, open_store, self.dir, "tarball")
+
+    def test_gc_command_needs_content_addressed_layout(self):
+        with patch('sys.stderr'):
+            self.assertEqual(1, golden_store.main(["golden_store", "gc", self.dir]))
+            self.assertEqual(2, golden_store.main(["golden_store", "collect", self.dir]))
+
+if __name__ == '__main__':
+    unittest.main()
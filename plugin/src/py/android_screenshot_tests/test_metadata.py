@@ -58,6 +58,133 @@ class TestMetadata(unittest.TestCase):
 
         self.assertEqual(7, self.get_num_screenshots_in(self.tmp_metadata))
 
+    def test_filter_by_test_class(self):
+        screenshot_filter = metadata.ScreenshotFilter(
+            include={'test_class': ['SelectAtTagActivityTest$']},
+            exclude={'test_name': ['InTitleBarMode', 'Creation']})
+        index = metadata.filter_screenshots(self.tmp_metadata, screenshot_filter=screenshot_filter)
+
+        self.assertEqual(
+            ["com.facebook.places.checkin.activity.SelectAtTagActivityTest_testAddPlaceIsShowing",
+             "com.facebook.places.checkin.activity.SelectAtTagActivityTest_testSearchEditIsShowingInInlineSearchBarMode"],
+            [s.name for s in index])
+        self.assertEqual(2, self.get_num_screenshots_in(self.tmp_metadata))
+
+    def test_filter_by_names_and_regex(self):
+        screenshot_filter = metadata.ScreenshotFilter(names=[
+            "com.facebook.places.checkin.CheckinTitleBarTest_testEditBoxWithSkip",
+            "com.facebook.places.checkin.activity.SelectAtTagActivityTest_testSimpleCreation"])
+        metadata.filter_screenshots(self.tmp_metadata, name_regex="CheckinTitleBar",
+                                    screenshot_filter=screenshot_filter)
+
+        self.assertEqual(1, self.get_num_screenshots_in(self.tmp_metadata))
+
+    def test_filter_unknown_field(self):
+        self.assertRaises(ValueError, metadata.ScreenshotFilter, include={'colour': ['red']})
+
+    def test_empty_filter(self):
+        self.assertTrue(metadata.ScreenshotFilter().is_empty())
+        self.assertTrue(metadata.ScreenshotFilter(include={'name': []}).is_empty())
+        self.assertFalse(metadata.ScreenshotFilter(names=[]).is_empty())
+
+    def test_merge(self):
+        other = self.write_metadata("""<screenshots>
+<screenshot><name>com.foo.OtherTest_testOther</name></screenshot>
+</screenshots>""")
+        merged = self.write_metadata("")
+
+        metadata.merge_metadata([self.tmp_metadata, other], merged)
+
+        self.assertEqual(
+            self.get_num_screenshots_in(self.fixture_metadata) + 1,
+            self.get_num_screenshots_in(merged))
+
+    def test_merge_detects_name_collisions(self):
+        other = self.write_metadata("""<screenshots>
+<screenshot><name>com.foo.OtherTest_testOther</name></screenshot>
+<screenshot><name>com.facebook.places.checkin.CheckinTitleBarTest_testEditBoxWithSkip</name></screenshot>
+</screenshots>""")
+
+        try:
+            metadata.merge_metadata([self.tmp_metadata, other], self.write_metadata(""))
+            self.fail("expected exception")
+        except RuntimeError as e:
+            self.assertIn("CheckinTitleBarTest_testEditBoxWithSkip", e.args[0])
+            self.assertNotIn("testOther", e.args[0])
+
+    def test_filter_keeps_the_screenshots_as_they_are(self):
+        metadata.filter_screenshots(self.tmp_metadata, name_regex="testAddPlaceIsShowing")
+
+        screenshot = ET.parse(self.tmp_metadata).getroot().find('screenshot')
+        self.assertEqual(
+            "/data/data/com.facebook.places.tests/app_screenshots-default/"
+            "com.facebook.places.checkin.activity.SelectAtTagActivityTest_testAddPlaceIsShowing.png",
+            screenshot.find('absolute_file_name').text)
+        self.assertFalse(os.path.exists(self.tmp_metadata + ".filtered"))
+
+    def test_filter_invalid_metadata(self):
+        path = self.write_metadata("<screenshots><screenshot><name>foo</name></screen")
+
+        self.assertRaises(ET.ParseError, metadata.filter_screenshots, path, name_regex="foo")
+        self.assertFalse(os.path.exists(path + ".filtered"))
+
+    def test_screenshot_elements_are_streamed(self):
+        elements = []
+        for element in metadata.iter_screenshot_elements(self.fixture_metadata):
+            self.assertIsNotNone(element.find('name'))
+            elements.append(element)
+
+        self.assertEqual(11, len(elements))
+        # every element was released once it was processed
+        self.assertEqual([0] * 11, [len(element) for element in elements])
+
+    def test_index(self):
+        index = metadata.ScreenshotIndex.load(self.write_metadata("""<screenshots>
+<screenshot>
+  <description/>
+  <name>com.foo.BarTest_testBaz</name>
+  <test_class>
+  com.foo.BarTest</test_class>
+  <test_name>testBaz</test_name>
+  <group>bar</group>
+  <tile_width>2</tile_width>
+  <tile_height>1</tile_height>
+  <relative_file_name>com.foo.BarTest_testBaz.png</relative_file_name>
+  <relative_file_name>com.foo.BarTest_testBaz_1_0.png</relative_file_name>
+  <view_hierarchy>com.foo.BarTest_testBaz_dump.xml</view_hierarchy>
+  <extras><key>value</key></extras>
+</screenshot>
+<screenshot><name>com.foo.BarTest_testError</name><error>Out of memory</error></screenshot>
+</screenshots>"""))
+
+        self.assertEqual(2, len(index))
+        s, error = index
+        self.assertEqual("com.foo.BarTest_testBaz", s.name)
+        self.assertEqual("com.foo.BarTest", s.test_class)
+        self.assertEqual("bar", s.group)
+        self.assertEqual((2, 1), (s.tile_width, s.tile_height))
+        self.assertEqual([("key", "value")], s.extras)
+        self.assertEqual(["com.foo.BarTest_testBaz.png",
+                          "com.foo.BarTest_testBaz_1_0.png",
+                          "com.foo.BarTest_testBaz_dump.xml"],
+                         index.device_files())
+        self.assertEqual("Out of memory", error.error)
+        self.assertIsNone(error.tile_width)
+
+    def test_filter_returns_index(self):
+        index = metadata.filter_screenshots(self.tmp_metadata, name_regex=".*CheckinTitleBar.*")
+
+        self.assertEqual(7, len(index))
+        self.assertEqual(7, self.get_num_screenshots_in(self.tmp_metadata))
+
+    def write_metadata(self, contents):
+        fd, path = tempfile.mkstemp(prefix="TempMetadataXml")
+        os.close(fd)
+        with open(path, "w") as f:
+            f.write(contents)
+        self.addCleanup(os.unlink, path)
+        return path
+
     def get_num_screenshots_in(self, metadata_file):
         """Gets the number of screenshots in the given metadata file"""
         return len(list(ET.parse(metadata_file).getroot().iter('screenshot')))
@@ -16,8 +16,11 @@ import unittest
 import os
 import sys
 from . import pull_screenshots
+from . import metadata
 import tempfile
 import shutil
+import subprocess
+import json
 import xml.etree.ElementTree as ET
 from os.path import join
 
@@ -26,11 +29,12 @@ if sys.version_info >= (3,):
 else:
     from mock import *
 
-from .common import assertRegex
+from .common import assertRegex, md5sum
 
 TESTING_PACKAGE = 'com.foo'
 CURRENT_DIR = os.path.dirname(__file__)
 FIXTURE_DIR = '%s/fixtures/sdcard/screenshots/%s/screenshots-default' % (CURRENT_DIR, TESTING_PACKAGE)
+DEVICE_DIR = '/sdcard/screenshots/%s/screenshots-default' % TESTING_PACKAGE
 
 
 class LocalFileHelper:
@@ -49,12 +53,37 @@ def assert_nice_filename(filename):
 class AdbPuller:
     def __init__(self, fixture_dir=join(CURRENT_DIR, "fixtures")):
         self.fixture_dir = fixture_dir
+        # the names of all the files that came across
+        self.transferred = []
 
     def pull(self, src, dest):
         self._valid_src(src)
         assert_nice_filename(src)
         src = self.fixture_dir + src
         shutil.copyfile(src, dest)
+        self.transferred.append(os.path.basename(src))
+
+    def pull_dir(self, src, dest):
+        self._valid_src(src)
+        shutil.copytree(self.fixture_dir + src, dest)
+        self.transferred.extend(os.listdir(dest))
+
+    def remove(self, src):
+        self._valid_src(src)
+        os.unlink(self.fixture_dir + src)
+
+    def instrument(self, component, args={}):
+        self.instrumented = (component, args)
+        for f in ["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                  "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"]:
+            yield "INSTRUMENTATION_STATUS: HostFileSender_filename=%s/%s\r\n" % (DEVICE_DIR, f)
+            yield "INSTRUMENTATION_STATUS_CODE: -1\r\n"
+        yield "INSTRUMENTATION_CODE: -1\r\n"
+
+    def remote_checksums(self, src):
+        self._valid_src(src)
+        src = self.fixture_dir + src
+        return dict((f, md5sum(join(src, f))) for f in os.listdir(src))
 
     def remote_file_exists(self, src):
         self._valid_src(src)
@@ -76,6 +105,38 @@ class TestAdbHelpers(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
+    def test_pull_filtered_only_pulls_selected_screenshots(self):
+        screenshot_filter = metadata.ScreenshotFilter(exclude={'test_name': ['^testSecond']})
+        adb_puller = AdbPuller()
+        failures = pull_screenshots.pull_filtered(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller,
+                                                  screenshot_filter=screenshot_filter)
+
+        self.assertEqual([], failures)
+        self.assertEqual(["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                          "metadata.xml",
+                          "one_dump.xml"],
+                         sorted(os.listdir(self.tmpdir)))
+        # the excluded screenshot didn't even come across
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), sorted(adb_puller.transferred))
+
+    def test_pull_unfiltered_pulls_in_bulk(self):
+        adb_puller = AdbPuller()
+        with patch.object(adb_puller, 'pull_dir', wraps=adb_puller.pull_dir) as mock_pull_dir:
+            pull_screenshots.pull_filtered(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller,
+                                           screenshot_filter=metadata.ScreenshotFilter())
+            self.assertTrue(mock_pull_dir.called)
+
+    def test_pull_filtered_by_name_only_transfers_selected_screenshots(self):
+        adb_puller = AdbPuller()
+        failures = pull_screenshots.pull_filtered(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller,
+                                                  filter_name_regex=".*testGetTextView.*")
+
+        self.assertEqual([], failures)
+        self.assertEqual(["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                          "metadata.xml",
+                          "one_dump.xml"],
+                         sorted(adb_puller.transferred))
+
     def test_pull_metadata_without_metadata(self):
         adb_instance = MagicMock()
 
@@ -89,6 +150,268 @@ class TestAdbHelpers(unittest.TestCase):
 
         self.assertTrue(os.path.exists(self.tmpdir + "/metadata.xml"))
 
+    def test_pull_images_uses_a_single_bulk_pull(self):
+        adb_puller = AdbPuller()
+        adb_puller.pull = MagicMock(side_effect=Exception("should not be called"))
+
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller)
+
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png")))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+        self.assertEqual(["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                          "com.foo.ScriptsFixtureTest_testSecondScreenshot.png",
+                          "metadata.xml",
+                          "one_dump.xml"],
+                         sorted(os.listdir(self.tmpdir)))
+
+    def test_pull_images_falls_back_for_files_missing_from_bulk_pull(self):
+        adb_puller = AdbPuller()
+        real_pull_dir = adb_puller.pull_dir
+
+        def partial_pull_dir(src, dest):
+            real_pull_dir(src, dest)
+            os.unlink(join(dest, "one_dump.xml"))
+
+        adb_puller.pull_dir = partial_pull_dir
+
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        adb_puller.pull = MagicMock(side_effect=adb_puller.pull)
+        pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller)
+
+        adb_puller.pull.assert_called_once_with(device_dir + "one_dump.xml", join(self.tmpdir, "one_dump.xml"))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+
+    def test_pull_images_without_bulk_support(self):
+        adb_puller = AdbPuller()
+        adb_puller.pull_dir = MagicMock(side_effect=OSError("not supported"))
+
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller)
+
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")))
+
+    def test_concurrent_pull(self):
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        failures = pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=AdbPuller(),
+                                                bulk=False, jobs=4)
+
+        self.assertEqual([], failures)
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png")))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+
+    @patch.object(pull_screenshots, 'PULL_RETRY_DELAY', 0)
+    def test_transient_pull_errors_are_retried(self):
+        adb_puller = AdbPuller()
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        real_pull = adb_puller.pull
+        attempts = []
+
+        def flaky_pull(src, dest):
+            attempts.append(src)
+            if attempts.count(src) == 1:
+                raise subprocess.CalledProcessError(1, ["adb", "pull", src])
+            real_pull(src, dest)
+
+        adb_puller.pull = flaky_pull
+        failures = pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller,
+                                                bulk=False, jobs=2)
+
+        self.assertEqual([], failures)
+        self.assertEqual(6, len(attempts))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+
+    @patch.object(pull_screenshots, 'PULL_RETRY_DELAY', 0)
+    def test_failed_pull_does_not_abort_the_others(self):
+        adb_puller = AdbPuller()
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        real_pull = adb_puller.pull
+
+        def broken_pull(src, dest):
+            if src.endswith("one_dump.xml"):
+                raise subprocess.CalledProcessError(1, ["adb", "pull", src])
+            real_pull(src, dest)
+
+        adb_puller.pull = broken_pull
+        failures = pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller,
+                                                bulk=False, jobs=3)
+
+        self.assertEqual(["one_dump.xml"], [f for f, error in failures])
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png")))
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")))
+
+    def test_incremental_pull_only_pulls_changed_files(self):
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+
+        with open(join(self.tmpdir, "one_dump.xml"), "w") as f:
+            f.write("stale")
+        os.unlink(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"))
+
+        adb_puller = AdbPuller()
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        adb_puller.pull = MagicMock(side_effect=adb_puller.pull)
+        adb_puller.pull_dir = MagicMock(side_effect=Exception("should not be called"))
+
+        with patch('sys.stdout'):
+            failures = pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller,
+                                                    incremental=True)
+
+        self.assertEqual([], failures)
+        self.assertEqual(
+            sorted([device_dir + "com.foo.ScriptsFixtureTest_testSecondScreenshot.png",
+                    device_dir + "one_dump.xml"]),
+            sorted(c[0][0] for c in adb_puller.pull.call_args_list))
+        self.assertEqual(md5sum(join(FIXTURE_DIR, "one_dump.xml")),
+                         md5sum(join(self.tmpdir, "one_dump.xml")))
+
+    def test_incremental_pull_without_checksums_warns(self):
+        adb_puller = AdbPuller()
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller)
+        adb_puller.remote_checksums = MagicMock(return_value={})
+
+        with patch('sys.stdout'), patch('sys.stderr') as stderr:
+            pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller, incremental=True)
+        assertRegex(self, "".join(c[0][0] for c in stderr.write.call_args_list),
+                    "Could not checksum the files on the device")
+
+    def test_incremental_pull_into_empty_dir_uses_bulk_pull(self):
+        adb_puller = AdbPuller()
+        device_dir = pull_screenshots.pull_metadata(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        adb_puller.pull = MagicMock(side_effect=Exception("should not be called"))
+
+        with patch('sys.stdout'):
+            pull_screenshots.pull_images(self.tmpdir, device_dir, adb_puller=adb_puller,
+                                         incremental=True)
+
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+
+    def test_host_sender_files(self):
+        lines = ["INSTRUMENTATION_STATUS: class=com.foo.ScriptsFixtureTest\r\n",
+                 "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+                 "INSTRUMENTATION_STATUS_CODE: -1\r\n",
+                 "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/bar.png\n",
+                 "INSTRUMENTATION_CODE: -1\n"]
+
+        with patch('sys.stdout'):
+            self.assertEqual(["/sdcard/foo.png", "/sdcard/bar.png"],
+                             list(pull_screenshots._host_sender_files(lines)))
+
+    def assert_host_sender_files_fail(self, lines):
+        with patch('sys.stdout'):
+            files = pull_screenshots._host_sender_files(lines)
+            self.assertEqual("/sdcard/foo.png", next(files))
+            self.assertRaises(RuntimeError, list, files)
+
+    def test_host_sender_files_with_failed_instrumentation(self):
+        self.assert_host_sender_files_fail([
+            "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+            "INSTRUMENTATION_STATUS_CODE: -1\r\n",
+            "INSTRUMENTATION_FAILED: com.foo.tests/Runner\r\n"])
+
+    def test_host_sender_files_with_crash(self):
+        self.assert_host_sender_files_fail([
+            "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+            "INSTRUMENTATION_STATUS_CODE: -1\r\n",
+            "INSTRUMENTATION_RESULT: shortMsg=Process crashed.\r\n",
+            "INSTRUMENTATION_CODE: 0\r\n"])
+
+    def test_host_sender_files_with_failing_test(self):
+        self.assert_host_sender_files_fail([
+            "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+            "INSTRUMENTATION_STATUS_CODE: -1\r\n",
+            "INSTRUMENTATION_STATUS: test=testFoo\r\n",
+            "INSTRUMENTATION_STATUS_CODE: -2\r\n",
+            "INSTRUMENTATION_CODE: -1\r\n"])
+
+    def test_host_sender_files_without_result(self):
+        self.assert_host_sender_files_fail([
+            "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+            "INSTRUMENTATION_STATUS_CODE: -1\r\n"])
+
+    @patch.object(pull_screenshots, 'PULL_RETRY_DELAY', 0)
+    def test_pull_during_instrumentation(self):
+        fixtures = join(tempfile.mkdtemp(), "fixtures")
+        self.addCleanup(shutil.rmtree, os.path.dirname(fixtures))
+        shutil.copytree(join(CURRENT_DIR, "fixtures"), fixtures)
+        adb_puller = AdbPuller(fixtures)
+
+        with patch('sys.stdout'):
+            failures = pull_screenshots.pull_during_instrumentation(
+                "com.foo.tests/android.support.test.runner.AndroidJUnitRunner",
+                self.tmpdir,
+                adb_puller=adb_puller,
+                jobs=2)
+
+        self.assertEqual([], failures)
+        self.assertEqual(("com.foo.tests/android.support.test.runner.AndroidJUnitRunner",
+                          {"HostFileSender_supported": "true"}),
+                         adb_puller.instrumented)
+        self.assertEqual(["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                          "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"],
+                         sorted(os.listdir(self.tmpdir)))
+        self.assertFalse(os.path.exists(fixtures + DEVICE_DIR + "/com.foo.ScriptsFixtureTest_testSecondScreenshot.png"))
+
+        # the remaining files are pulled once the instrumentation is done
+        with patch('sys.stdout'):
+            failures = pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller)
+        self.assertEqual(2, len(failures))
+
+        failures = pull_screenshots.pull_filtered(TESTING_PACKAGE, self.tmpdir, adb_puller=adb_puller,
+                                                  only_missing=True)
+        self.assertEqual([], failures)
+        self.assertTrue(os.path.exists(join(self.tmpdir, "one_dump.xml")))
+
+    def _second_device_fixtures(self):
+        fixtures = join(tempfile.mkdtemp(), "fixtures")
+        self.addCleanup(shutil.rmtree, os.path.dirname(fixtures))
+        shutil.copytree(join(CURRENT_DIR, "fixtures"), fixtures)
+
+        device_dir = join(fixtures, "sdcard/screenshots/com.foo/screenshots-default")
+        shutil.move(join(device_dir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"),
+                    join(device_dir, "com.foo.ScriptsFixtureTest_testThirdScreenshot.png"))
+        with open(join(device_dir, "metadata.xml"), "w") as f:
+            f.write("""<screenshots>
+  <screenshot>
+    <name>com.foo.ScriptsFixtureTest_testThirdScreenshot</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+    <relative_file_name>com.foo.ScriptsFixtureTest_testThirdScreenshot.png</relative_file_name>
+  </screenshot>
+</screenshots>""")
+        return fixtures
+
+    def test_pull_sharded(self):
+        failures = pull_screenshots.pull_sharded(
+            TESTING_PACKAGE,
+            self.tmpdir,
+            adb_pullers=[AdbPuller(), AdbPuller(self._second_device_fixtures())])
+
+        self.assertEqual([], failures)
+        self.assertEqual(["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                          "com.foo.ScriptsFixtureTest_testSecondScreenshot.png",
+                          "com.foo.ScriptsFixtureTest_testThirdScreenshot.png",
+                          "metadata.xml",
+                          "one_dump.xml"],
+                         sorted(os.listdir(self.tmpdir)))
+
+        names = [s.find('name').text for s in ET.parse(join(self.tmpdir, "metadata.xml")).getroot().iter('screenshot')]
+        self.assertEqual(4, len(names))
+        self.assertIn("com.foo.ScriptsFixtureTest_testThirdScreenshot", names)
+
+    def test_pull_sharded_detects_collisions(self):
+        try:
+            pull_screenshots.pull_sharded(
+                TESTING_PACKAGE,
+                self.tmpdir,
+                adb_pullers=[AdbPuller(), AdbPuller()])
+            self.fail("expected exception")
+        except RuntimeError as e:
+            assertRegex(self, e.args[0], ".*testSecondScreenshot.*")
+
 
 class TestPullScreenshots(unittest.TestCase):
     def setUp(self):
@@ -139,12 +462,174 @@ class TestPullScreenshots(unittest.TestCase):
             assertRegex(self, contents, ".*com.foo.*")
             self.assertTrue(contents.find('<img src="./com.foo.') >= 0)
 
+    def test_thumbnails(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        LocalFileHelper().setup(self.tmpdir)
+        with patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE,
+                                              adb_puller=None,
+                                              perform_pull=False,
+                                              temp_dir=self.tmpdir,
+                                              thumbnails=True)
+
+        with open(join(self.tmpdir, "index.html")) as f:
+            contents = f.read()
+        self.assertIn('<img class="thumbnail" src="thumbnails/com.foo.ScriptsFixtureTest_testSecondScreenshot.png"',
+                      contents)
+        self.assertIn('<table class="img-wrapper full_size">', contents)
+        self.assertTrue(os.path.exists(
+            join(self.tmpdir, "thumbnails", "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")))
+
+    @patch.object(pull_screenshots, 'REPORT_PAGE_THRESHOLD', 1)
+    def test_large_report_is_split_into_pages(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        LocalFileHelper().setup(self.tmpdir)
+        with open(join(self.tmpdir, pull_screenshots.VERIFY_REPORT), "w") as f:
+            json.dump({"screenshots": 2,
+                       "failures": [{"name": "com.foo.ScriptsFixtureTest_testSecondScreenshot",
+                                     "reason": "missing"}]}, f)
+
+        with open(pull_screenshots.generate_html(self.tmpdir)) as f:
+            contents = f.read()
+        self.assertIn('<a href="page_1.html">com.facebook.testing.screenshot.ScriptsFixtureTest</a> '
+                      '(2 screenshots, 1 failed)', contents)
+        self.assertNotIn('<img', contents)
+
+        with open(join(self.tmpdir, "page_1.html")) as f:
+            contents = f.read()
+        self.assertIn('<img src="./com.foo.ScriptsFixtureTest_testSecondScreenshot.png" loading="lazy" />',
+                      contents)
+
+    @patch.object(pull_screenshots, 'REPORT_PAGE_THRESHOLD', 1)
+    def test_large_report_for_png_is_not_split(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        LocalFileHelper().setup(self.tmpdir)
+
+        # the report is removed once it's rendered
+        with patch.object(pull_screenshots, 'generate_png') as mock_generate_png, \
+             patch.object(pull_screenshots.shutil, 'rmtree'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                              temp_dir=self.tmpdir, opt_generate_png="out.png")
+            with open(mock_generate_png.call_args[0][0]) as f:
+                contents = f.read()
+        self.assertIn('<img src="./com.foo.ScriptsFixtureTest_testSecondScreenshot.png"', contents)
+        self.assertFalse(os.path.exists(join(self.tmpdir, "page_1.html")))
+
+    def test_generate_html_lists_the_directory_once(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        os.unlink(join(self.tmpdir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"))
+
+        with patch.object(os.path, 'exists', wraps=os.path.exists) as mock_exists, \
+             patch.object(os, 'listdir', wraps=os.listdir) as mock_listdir:
+            html = pull_screenshots.generate_html(self.tmpdir)
+
+        self.assertEqual(1, mock_listdir.call_count)
+        self.assertEqual([call(join(self.tmpdir, pull_screenshots.VERIFY_REPORT))], mock_exists.call_args_list)
+        with open(html) as f:
+            contents = f.read()
+        self.assertIn('<img src="./com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png"', contents)
+        self.assertNotIn('<img src="./com.foo.ScriptsFixtureTest_testSecondScreenshot.png"', contents)
+
+    def test_report_only_uses_local_assets(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        with patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=AdbPuller(), temp_dir=self.tmpdir)
+
+        with open(join(self.tmpdir, "index.html")) as f:
+            contents = f.read()
+        self.assertNotIn("http:", contents)
+        self.assertNotIn("https:", contents)
+        for asset in ["default.js", "default.css"]:
+            self.assertIn(asset, contents)
+            self.assertTrue(os.path.exists(join(self.tmpdir, asset)))
+
+    @patch.object(pull_screenshots, 'PULL_RETRY_DELAY', 0)
+    def test_failed_pulls_fail_the_run(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        adb_puller = AdbPuller()
+        real_pull = adb_puller.pull
+
+        def broken_pull(src, dest):
+            if src.endswith(".png"):
+                raise subprocess.CalledProcessError(1, ["adb", "pull", src])
+            real_pull(src, dest)
+
+        adb_puller.pull = broken_pull
+        adb_puller.pull_dir = MagicMock(side_effect=subprocess.CalledProcessError(1, ["adb", "pull"]))
+        with patch('sys.stdout'), patch('sys.stderr'):
+            self.assertEqual(1, pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=adb_puller,
+                                                                  temp_dir=self.tmpdir))
+        # the report is still there
+        self.assertTrue(os.path.exists(join(self.tmpdir, "index.html")))
+
+    def test_successful_run(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        with patch('sys.stdout'):
+            self.assertEqual(0, pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=AdbPuller(),
+                                                                  temp_dir=self.tmpdir))
+
+    def test_pullers_are_closed(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        adb_puller = AdbPuller()
+        adb_puller.close = MagicMock()
+        with patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=adb_puller, temp_dir=self.tmpdir)
+        self.assertEqual(1, adb_puller.close.call_count)
+
+    def test_pullers_are_closed_when_pulling_fails(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        adb_pullers = [AdbPuller(), AdbPuller()]
+        for adb_puller in adb_pullers:
+            adb_puller.close = MagicMock()
+        with patch.object(pull_screenshots, 'pull_sharded', side_effect=RuntimeError("device gone")):
+            self.assertRaises(RuntimeError, pull_screenshots.pull_screenshots, TESTING_PACKAGE,
+                              adb_puller=adb_pullers, temp_dir=self.tmpdir)
+        self.assertEqual([1, 1], [adb_puller.close.call_count for adb_puller in adb_pullers])
+
     def test_generate_html_returns_a_valid_file(self):
         self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
         pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
         html = pull_screenshots.generate_html(self.tmpdir)
         self.assertTrue(os.path.exists(html))
 
+    def test_verify_failures_are_linked(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        failure_dir = join(self.tmpdir, "verify_failures")
+        os.mkdir(failure_dir)
+        name = "com.foo.ScriptsFixtureTest_testGetTextViewScreenshot"
+        failure = {"name": name, "reason": "pixels", "expected": "/nonexistent/" + name + ".png"}
+        for kind in ["actual", "diff", "composite"]:
+            failure[kind] = join(failure_dir, "%s_%s.png" % (name, kind))
+            open(failure[kind], "w").close()
+        with open(join(self.tmpdir, pull_screenshots.VERIFY_REPORT), "w") as f:
+            json.dump({"screenshots": 2, "failures": [failure]}, f)
+
+        with open(pull_screenshots.generate_html(self.tmpdir)) as f:
+            contents = f.read()
+        self.assertIn('<a href="verify_failures/%s_diff.png">diff</a>' % name, contents)
+        self.assertIn('<img class="composite" src="verify_failures/%s_composite.png" loading="lazy" />' % name, contents)
+        self.assertNotIn("/nonexistent/", contents)
+        self.assertEqual(1, contents.count("screenshot_failure"))
+
+    def test_stale_verify_failures_are_not_reported(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        os.mkdir(join(self.tmpdir, "verify_failures"))
+        name = "com.foo.ScriptsFixtureTest_testGetTextViewScreenshot"
+        with open(join(self.tmpdir, pull_screenshots.VERIFY_REPORT), "w") as f:
+            json.dump({"screenshots": 2, "failures": [{"name": name, "reason": "size"}]}, f)
+
+        with patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                              temp_dir=self.tmpdir)
+
+        with open(join(self.tmpdir, "index.html")) as f:
+            self.assertNotIn("screenshot_failure", f.read())
+        self.assertFalse(os.path.exists(join(self.tmpdir, pull_screenshots.VERIFY_REPORT)))
+        self.assertFalse(os.path.exists(join(self.tmpdir, "verify_failures")))
+
     def test_adb_puller_sanity(self):
         self.assertTrue(AdbPuller().remote_file_exists("/sdcard"))
 
@@ -209,6 +694,52 @@ class TestPullScreenshots(unittest.TestCase):
                                           temp_dir=source,
                                           verify=dest)
 
+    def test_metadata_is_parsed_once(self):
+        source = tempfile.mkdtemp()
+        dest = tempfile.mkdtemp()
+
+        LocalFileHelper().setup(source)
+        LocalFileHelper().setup(dest)
+
+        with patch.object(metadata.ScreenshotIndex, 'load', wraps=metadata.ScreenshotIndex.load) as mock_load, \
+             patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE,
+                                              adb_puller=None,
+                                              perform_pull=False,
+                                              temp_dir=source,
+                                              verify=dest)
+        self.assertEqual(1, mock_load.call_count)
+
+    def test_record_and_verify_content_addressed_goldens(self):
+        source = tempfile.mkdtemp()
+        dest = join(tempfile.mkdtemp(), "goldens")
+        self.addCleanup(shutil.rmtree, source)
+        self.addCleanup(shutil.rmtree, os.path.dirname(dest))
+        LocalFileHelper().setup(source)
+
+        with patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                              temp_dir=source, record=dest,
+                                              golden_layout="content-addressed")
+            # the layout is detected when verifying
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                              temp_dir=source, verify=dest)
+
+        self.assertEqual(["blobs", "goldens.json"], sorted(os.listdir(dest)))
+
+    def test_incremental_record_prints_summary(self):
+        source = tempfile.mkdtemp()
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        self.addCleanup(shutil.rmtree, dest)
+        LocalFileHelper().setup(source)
+
+        with patch('sys.stdout') as stdout:
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                              temp_dir=source, record=dest, incremental_record=True)
+        output = "".join(call[0][0] for call in stdout.write.call_args_list)
+        assertRegex(self, output, "Recorded 0 changed, [1-9][0-9]* added and 0 removed screenshots")
+
     def test_no_pull_argument_does_not_use_adb_on_record(self):
         source = tempfile.mkdtemp()
         dest = tempfile.mkdtemp()
@@ -241,11 +772,39 @@ class TestPullScreenshots(unittest.TestCase):
           <screenshot><name>three</name><group>foo</group></screenshot>
         </screenshots>""")
 
-        screenshots = pull_screenshots.sort_screenshots(xml.iter('screenshot'))
+        screenshots = pull_screenshots.sort_screenshots(
+            metadata.Screenshot.from_element(s) for s in xml.iter('screenshot'))
 
         self.assertEquals(
             ["two", "one", "three"],
-            [x.find('name').text for x in screenshots])
+            [x.name for x in screenshots])
+
+    def test_pull_screenshots_with_instrumentation(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        fixtures = join(self.tmpdir, "fixtures")
+        shutil.copytree(join(CURRENT_DIR, "fixtures"), fixtures)
+        temp_dir = join(self.tmpdir, "out")
+        os.mkdir(temp_dir)
+
+        with patch('sys.stdout'):
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE,
+                                              adb_puller=AdbPuller(fixtures),
+                                              temp_dir=temp_dir,
+                                              instrumentation="com.foo.tests/Runner")
+
+        self.assertTrue(os.path.exists(join(temp_dir, "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")))
+        self.assertTrue(os.path.exists(join(temp_dir, "one_dump.xml")))
+        self.assertFalse(os.path.exists(fixtures + DEVICE_DIR + "/com.foo.ScriptsFixtureTest_testSecondScreenshot.png"))
+
+    def test_instrumentation_requires_single_device(self):
+        try:
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE,
+                                              adb_puller=[AdbPuller(), AdbPuller()],
+                                              temp_dir=tempfile.mkdtemp(),
+                                              instrumentation="com.foo.tests/Runner")
+            self.fail("expected exception")
+        except RuntimeError as e:
+            assertRegex(self, e.args[0], ".*single device.*")
 
     def test_invalid_xml(self):
         source = join(tempfile.mkdtemp(), "foo")
@@ -267,6 +826,176 @@ class TestPullScreenshots(unittest.TestCase):
         except RuntimeError as e:
             assertRegex(self, e.args[0], ".*ScreenshotRunner.*")
 
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.oldenviron = dict(os.environ)
+        os.environ['ANDROID_SDK'] = '/tmp/sdk'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.oldenviron)
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_pull_jobs(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--pull-jobs=8"])
+        self.assertEqual(8, mock_pull_screenshots.call_args[1]['pull_jobs'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_pull_jobs_defaults_to_serial(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE])
+        self.assertEqual(1, mock_pull_screenshots.call_args[1]['pull_jobs'])
+        self.assertEqual(1, mock_pull_screenshots.call_args[1]['jobs'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_jobs(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--jobs=8", "--verify=screenshots"])
+        self.assertEqual(8, mock_pull_screenshots.call_args[1]['jobs'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_multiple_serials(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "-s", "emulator-5554", "-s", "emulator-5556"])
+        pullers = mock_pull_screenshots.call_args[1]['adb_puller']
+        self.assertEqual([["-s", "emulator-5554"], ["-s", "emulator-5556"]],
+                         [p._adb_args for p in pullers])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_single_serial(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "-s", "emulator-5554"])
+        self.assertEqual(["-s", "emulator-5554"],
+                         mock_pull_screenshots.call_args[1]['adb_puller']._adb_args)
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_persistent_adb(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--persistent-adb", "-s", "emulator-5554"])
+        adb_puller = mock_pull_screenshots.call_args[1]['adb_puller']
+        self.assertIsInstance(adb_puller, pull_screenshots.SyncPuller)
+        self.assertEqual("host:transport:emulator-5554", adb_puller._transport)
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_incremental_pull(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE])
+        self.assertFalse(mock_pull_screenshots.call_args[1]['incremental_pull'])
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--incremental-pull", "--temp-dir=/tmp/foo"])
+        self.assertTrue(mock_pull_screenshots.call_args[1]['incremental_pull'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_instrument(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--instrument=com.foo.tests/Runner"])
+        self.assertEqual("com.foo.tests/Runner", mock_pull_screenshots.call_args[1]['instrumentation'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_comparator_options(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--verify=screenshots"])
+        self.assertIsNone(mock_pull_screenshots.call_args[1]['comparator'])
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--verify=screenshots",
+                               "--channel-tolerance=3", "--max-diff-ratio=0.01"])
+        comparator = mock_pull_screenshots.call_args[1]['comparator']
+        self.assertEqual((3, 0.01), (comparator.channel_tolerance, comparator.max_diff_ratio))
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--verify=screenshots", "--min-ssim=0.98"])
+        self.assertEqual(0.98, mock_pull_screenshots.call_args[1]['comparator'].min_ssim)
+
+        mock_pull_screenshots.reset_mock()
+        with patch('sys.stderr'):
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--verify=screenshots",
+                                                       "--max-diff-ratio=0.01", "--min-ssim=0.98"]))
+        self.assertFalse(mock_pull_screenshots.called)
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_filter_options(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE,
+                               "--include=test_class:ScriptsFixtureTest", "--exclude=name:Second"])
+        screenshot_filter = mock_pull_screenshots.call_args[1]['screenshot_filter']
+        self.assertTrue(screenshot_filter(metadata.Screenshot("com.foo.ScriptsFixtureTest_testFirst",
+                                                              test_class="com.foo.ScriptsFixtureTest")))
+        self.assertFalse(screenshot_filter(metadata.Screenshot("com.foo.ScriptsFixtureTest_testSecond",
+                                                               test_class="com.foo.ScriptsFixtureTest")))
+
+        with patch('sys.stderr'):
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--include=color:red"]))
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--include=name:("]))
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_thumbnail_options(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE])
+        self.assertFalse(mock_pull_screenshots.call_args[1]['thumbnails'])
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--thumbnails", "--thumbnail-cache=/tmp/cache"])
+        self.assertTrue(mock_pull_screenshots.call_args[1]['thumbnails'])
+        self.assertEqual("/tmp/cache", mock_pull_screenshots.call_args[1]['thumbnail_cache'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_golden_layout(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots",
+                               "--golden-layout=content-addressed"])
+        self.assertEqual("content-addressed", mock_pull_screenshots.call_args[1]['golden_layout'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_invalid_golden_layout(self, mock_pull_screenshots):
+        with patch('sys.stderr'):
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots",
+                                                       "--golden-layout=tree"]))
+        self.assertFalse(mock_pull_screenshots.called)
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_png_profiles(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots"])
+        self.assertIsNone(mock_pull_screenshots.call_args[1]['golden_png_profile'])
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots",
+                               "--golden-png=default", "--report-png=smallest"])
+        self.assertEqual("default", mock_pull_screenshots.call_args[1]['golden_png_profile'])
+        self.assertEqual("smallest", mock_pull_screenshots.call_args[1]['report_png_profile'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_invalid_png_profile(self, mock_pull_screenshots):
+        with patch('sys.stderr'):
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots",
+                                                       "--golden-png=tiny"]))
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots",
+                                                       "--report-png=tiny"]))
+        self.assertFalse(mock_pull_screenshots.called)
+
+    def test_unknown_png_profile(self):
+        source = tempfile.mkdtemp()
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        self.addCleanup(shutil.rmtree, dest)
+        LocalFileHelper().setup(source)
+
+        self.assertRaises(ValueError, pull_screenshots.pull_screenshots, TESTING_PACKAGE, adb_puller=None,
+                          perform_pull=False, temp_dir=source, record=dest, golden_png_profile="tiny")
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_incremental_record(self, mock_pull_screenshots):
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots"])
+        self.assertFalse(mock_pull_screenshots.call_args[1]['incremental_record'])
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--record=screenshots",
+                               "--incremental-record"])
+        self.assertTrue(mock_pull_screenshots.call_args[1]['incremental_record'])
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_only_failed(self, mock_pull_screenshots):
+        fd, report = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, report)
+        with open(report, "w") as f:
+            json.dump({"screenshots": 2, "failures": [{"name": "foo"}]}, f)
+
+        pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--only-failed=" + report])
+        screenshot_filter = mock_pull_screenshots.call_args[1]['screenshot_filter']
+        self.assertTrue(screenshot_filter(metadata.Screenshot("foo")))
+        self.assertFalse(screenshot_filter(metadata.Screenshot("bar")))
+
+    @patch.object(pull_screenshots, 'pull_screenshots')
+    def test_invalid_pull_jobs(self, mock_pull_screenshots):
+        with patch('sys.stderr'):
+            self.assertEqual(2, pull_screenshots.main(["pull_screenshots", TESTING_PACKAGE, "--pull-jobs=many"]))
+        self.assertFalse(mock_pull_screenshots.called)
+
 class TestAndroidJoin(unittest.TestCase):
     def test_simple(self):
         self.assertEquals("/foo/bar",
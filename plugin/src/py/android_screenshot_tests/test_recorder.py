@@ -12,11 +12,33 @@ import tempfile
 import unittest
 import shutil
 import os
+import sys
+import json
 from os.path import join, exists
 from .recorder import Recorder, VerifyError
+from . import recorder
+from .compare import ToleranceComparator
+from .golden_store import HASH_MANIFEST
 
 from PIL import Image
 
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+def create_screenshots(dir, colors):
+    """Writes the metadata of a single-tile screenshot for every name in
+    colors, and its 10x10 tile of the given color, into dir"""
+    with open(join(dir, "metadata.xml"), "w") as f:
+        f.write("<screenshots>%s</screenshots>" % "".join(
+            "<screenshot><name>%s</name><tile_width>1</tile_width>"
+            "<tile_height>1</tile_height></screenshot>" % name for name in sorted(colors)))
+    for name, color in colors.items():
+        im = Image.new("RGBA", (10, 10), color)
+        im.save(join(dir, name + ".png"), "PNG")
+        im.close()
+
 class TestRecorder(unittest.TestCase):
     def setUp(self):
         self.outputdir = tempfile.mkdtemp()
@@ -158,6 +180,43 @@ class TestRecorder(unittest.TestCase):
             self.assertEqual((0, 0, 255, 255), im.getpixel((11, 11)))
             self.assertEqual((255, 0, 0, 255), im.getpixel((1, 11)))
 
+    def test_tiles_are_laid_out_by_cumulative_offsets(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.create_temp_image("foobar_1_0.png", (12, 10), "red")
+        self.create_temp_image("foobar_2_0.png", (7, 10), "green")
+
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>3</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+
+        with Image.open(join(self.outputdir, "foobar.png")) as im:
+            self.assertEqual((29, 10), im.size)
+            self.assertEqual((255, 0, 0, 255), im.getpixel((21, 1)))
+            self.assertEqual((0, 128, 0, 255), im.getpixel((22, 1)))
+
+    def test_each_tile_is_opened_once(self):
+        for i in range(2):
+            for j in range(3):
+                self.create_temp_image("foobar%s.png" % ("" if i == j == 0 else "_%d_%d" % (i, j)),
+                                       (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>2</tile_width>
+    <tile_height>3</tile_height>
+</screenshot>
+</screenshots>""")
+
+        with patch.object(recorder.Image, "open", wraps=Image.open) as mock_open:
+            self.recorder.record()
+            self.assertEqual(6, mock_open.call_count)
+
     def test_verify_success(self):
         self.create_temp_image("foobar.png", (10, 10), "blue")
         self.make_metadata("""<screenshots>
@@ -191,5 +250,398 @@ class TestRecorder(unittest.TestCase):
         except VerifyError:
             pass  # expected
 
+    def test_verify_failure_writes_actual_image(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+        os.unlink(join(self.inputdir, "foobar.png"))
+        self.create_temp_image("foobar.png", (10, 10), "red")
+
+        try:
+            self.recorder.verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            actual = e.failures[0]["actual"]
+            with Image.open(actual) as im:
+                self.assertEqual((255, 0, 0, 255), im.getpixel((1, 1)))
+
+    def test_verify_reports_all_failures(self):
+        self.create_temp_image("foo.png", (10, 10), "blue")
+        self.create_temp_image("bar.png", (10, 10), "blue")
+        self.create_temp_image("baz.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foo</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+<screenshot>
+   <name>bar</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+<screenshot>
+   <name>baz</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+        self.recorder.record()
+
+        im = Image.new("RGBA", (10, 10), "blue")
+        im.paste(Image.new("RGBA", (2, 3), "red"), (4, 5))
+        im.save(join(self.inputdir, "foo.png"))
+        os.unlink(join(self.outputdir, "baz.png"))
+
+        try:
+            self.recorder.verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            self.assertEqual(["foo", "baz"], [f["name"] for f in e.failures])
+            self.assertEqual([4, 5, 6, 8], e.failures[0]["bbox"])
+            self.assertEqual(6, e.failures[0]["differing_pixels"])
+            self.assertEqual("missing", e.failures[1]["reason"])
+            self.assertIn("6 pixels differ in (4, 5, 6, 8)", e.args[0])
+
+        with open(join(self.inputdir, recorder.VERIFY_REPORT)) as f:
+            report = json.load(f)
+        self.assertEqual(3, report["screenshots"])
+        self.assertEqual(["foo", "baz"], [f["name"] for f in report["failures"]])
+
+    def test_verify_failure_writes_diff_images(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+        self.recorder.record()
+
+        im = Image.new("RGBA", (10, 10), "blue")
+        im.paste(Image.new("RGBA", (2, 3), "red"), (4, 5))
+        im.save(join(self.inputdir, "foobar.png"))
+
+        try:
+            self.recorder.verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            failure = e.failures[0]
+
+        self.assertEqual(join(self.inputdir, recorder.VERIFY_FAILURES, "foobar_diff.png"), failure["diff"])
+        with Image.open(failure["diff"]) as diff:
+            self.assertEqual(recorder.DIFF_HIGHLIGHT, diff.getpixel((4, 5)))
+            self.assertNotEqual(recorder.DIFF_HIGHLIGHT, diff.getpixel((0, 0)))
+        with Image.open(failure["composite"]) as composite:
+            self.assertEqual((30, 10), composite.size)
+            self.assertEqual((0, 0, 255, 255), composite.getpixel((4, 5)))
+            self.assertEqual((255, 0, 0, 255), composite.getpixel((14, 5)))
+        self.assertNotIn("mask", failure)
+
+    def test_verify_failure_without_golden_has_no_diff(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        try:
+            self.recorder.verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            self.assertIsNone(e.failures[0]["diff"])
+            self.assertIsNone(e.failures[0]["composite"])
+            self.assertTrue(exists(e.failures[0]["actual"]))
+
+    def test_record_removes_stale_verify_results(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.assertRaises(VerifyError, self.recorder.verify)
+        self.recorder.record()
+
+        self.assertFalse(exists(join(self.inputdir, recorder.VERIFY_REPORT)))
+        self.assertFalse(exists(join(self.inputdir, recorder.VERIFY_FAILURES)))
+
+    def test_verify_success_writes_report(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+        self.recorder.verify()
+
+        with open(join(self.inputdir, recorder.VERIFY_REPORT)) as f:
+            self.assertEqual({"screenshots": 1, "failures": []}, json.load(f))
+
+    def test_verify_with_tolerance(self):
+        self.create_temp_image("foobar.png", (10, 10), (0, 0, 255, 255))
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+        os.unlink(join(self.inputdir, "foobar.png"))
+        self.create_temp_image("foobar.png", (10, 10), (0, 2, 253, 255))
+
+        self.assertRaises(VerifyError, self.recorder.verify)
+        Recorder(self.inputdir, self.outputdir, comparator=ToleranceComparator(channel_tolerance=2)).verify()
+
+    def test_verify_different_size(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+        os.unlink(join(self.inputdir, "foobar.png"))
+        self.create_temp_image("foobar.png", (10, 11), "blue")
+
+        self.assertRaises(VerifyError, self.recorder.verify)
+
+    def test_verify_success_does_not_write_images(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+        with patch.object(Image.Image, "save") as mock_save:
+            self.recorder.verify()
+            self.assertFalse(mock_save.called)
+
+    def test_record_writes_hash_manifest(self):
+        self.create_temp_image("foo.png", (10, 10), "blue")
+        self.create_temp_image("bar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foo</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+<screenshot>
+   <name>bar</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+
+        self.recorder.record()
+
+        with open(join(self.outputdir, HASH_MANIFEST)) as f:
+            manifest = json.load(f)
+        self.assertEqual(["bar", "foo"], sorted(manifest))
+        self.assertEqual(manifest["foo"]["hash"], manifest["bar"]["hash"])
+        self.assertNotEqual(manifest["foo"]["hash"], manifest["foo"]["file_hash"])
+
+    def test_verify_uses_hash_manifest(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+        self.recorder.record()
+
+        opened = []
+        real_open = Image.open
+        def open_image(f, *args, **kwargs):
+            opened.append(f)
+            return real_open(f, *args, **kwargs)
+
+        with patch.object(recorder.Image, "open", side_effect=open_image):
+            self.recorder.verify()
+
+        self.assertNotIn(join(self.outputdir, "foobar.png"), opened)
+
+    def test_verify_ignores_stale_hash_manifest(self):
+        self.create_temp_image("foobar.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foobar</name>
+    <tile_width>1</tile_width>
+    <tile_height>1</tile_height>
+</screenshot>
+</screenshots>""")
+        self.recorder.record()
+
+        # the golden was replaced without updating the manifest
+        im = Image.new("RGBA", (10, 10), "red")
+        im.save(join(self.outputdir, "foobar.png"))
+        im.close()
+
+        self.assertRaises(VerifyError, self.recorder.verify)
+
+    def test_record_incremental(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue", "baz": "blue"})
+        Recorder(self.inputdir, self.outputdir).record()
+        for name in ["foo.png", "bar.png", "baz.png"]:
+            os.utime(join(self.outputdir, name), (1, 1))
+
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red", "qux": "red"})
+        os.unlink(join(self.inputdir, "baz.png"))
+        summary = self.recorder.record_incremental()
+
+        self.assertEqual({"changed": ["bar"], "added": ["qux"], "removed": ["baz"]}, summary)
+        self.assertEqual(["bar.png", "foo.png", HASH_MANIFEST, "qux.png"],
+                         sorted(os.listdir(self.outputdir)))
+        # the unchanged golden is left alone
+        self.assertEqual(1, os.stat(join(self.outputdir, "foo.png")).st_mtime)
+        self.assertNotEqual(1, os.stat(join(self.outputdir, "bar.png")).st_mtime)
+        self.recorder.verify()
+
+    def test_verify_writes_report_images_with_report_profile(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        self.recorder.record()
+        create_screenshots(self.inputdir, {"foo": "red"})
+
+        # in this process, so that the calls can be seen
+        with patch.object(recorder, "save_png", wraps=recorder.save_png) as mock_save:
+            self.assertRaises(VerifyError, Recorder(self.inputdir, self.outputdir).verify)
+            self.assertEqual(set([recorder.REPORT_PNG_PROFILE]),
+                             set(call[0][2] for call in mock_save.call_args_list))
+        self.assertTrue(exists(join(self.inputdir, recorder.VERIFY_FAILURES, "foo_diff.png")))
+
+    def test_record_incremental_without_changes(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        self.recorder.record()
+        os.utime(join(self.outputdir, HASH_MANIFEST), (1, 1))
+
+        with patch.object(Image.Image, "save") as mock_save:
+            summary = self.recorder.record_incremental()
+            self.assertFalse(mock_save.called)
+        self.assertEqual({"changed": [], "added": [], "removed": []}, summary)
+        self.assertEqual(1, os.stat(join(self.outputdir, HASH_MANIFEST)).st_mtime)
+
+    def test_record_incremental_without_manifest(self):
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "blue"})
+        self.recorder.record()
+        os.unlink(join(self.outputdir, HASH_MANIFEST))
+
+        create_screenshots(self.inputdir, {"foo": "blue", "bar": "red"})
+        summary = self.recorder.record_incremental()
+
+        self.assertEqual({"changed": ["bar"], "added": [], "removed": []}, summary)
+        self.assertTrue(exists(join(self.outputdir, HASH_MANIFEST)))
+        self.recorder.verify()
+
+    def test_record_incremental_keeps_unchanged_goldens_without_manifest(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        # as recorded before there was a manifest, with another encoding
+        with Image.open(join(self.inputdir, "foo.png")) as im:
+            im.save(join(self.outputdir, "foo.png"), "PNG", compress_level=1)
+        os.utime(join(self.outputdir, "foo.png"), (1, 1))
+        with open(join(self.outputdir, "foo.png"), "rb") as f:
+            golden = f.read()
+
+        summary = self.recorder.record_incremental()
+
+        self.assertEqual({"changed": [], "added": [], "removed": []}, summary)
+        with open(join(self.outputdir, "foo.png"), "rb") as f:
+            self.assertEqual(golden, f.read())
+        self.assertEqual(1, os.stat(join(self.outputdir, "foo.png")).st_mtime)
+        with open(join(self.outputdir, HASH_MANIFEST)) as f:
+            self.assertEqual(["foo"], sorted(json.load(f)))
+        self.recorder.verify()
+
+    def test_record_incremental_removes_verify_results(self):
+        create_screenshots(self.inputdir, {"foo": "blue"})
+        self.recorder.record()
+        create_screenshots(self.inputdir, {"foo": "red"})
+        self.assertRaises(VerifyError, self.recorder.verify)
+
+        self.recorder.record_incremental()
+        self.assertFalse(exists(join(self.inputdir, recorder.VERIFY_FAILURES)))
+        self.recorder.verify()
+
+    def test_first_failure_is_raised(self):
+        self.create_temp_image("foo.png", (10, 10), "blue")
+        self.create_temp_image("baz.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+<screenshot>
+   <name>foo</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+<screenshot>
+   <name>bar</name>
+   <tile_width>1</tile_width>
+   <tile_height>1</tile_height>
+</screenshot>
+<screenshot>
+   <name>baz</name>
+   <tile_width>1</tile_width>
+   <tile_height>2</tile_height>
+</screenshot>
+</screenshots>""")
+
+        try:
+            self.recorder.record()
+            self.fail("expected exception")
+        except IOError as e:
+            self.assertIn("bar.png", str(e))
+
+class TestRecorderWithJobs(TestRecorder):
+    def setUp(self):
+        TestRecorder.setUp(self)
+        self.recorder = Recorder(self.inputdir, self.outputdir, jobs=3)
+
+    def test_output_does_not_depend_on_jobs(self):
+        names = []
+        for i in range(6):
+            name = "screenshot%d" % i
+            names.append(name)
+            self.create_temp_image(name + ".png", (10, 10), (40 * i, 0, 0, 255))
+            self.create_temp_image(name + "_0_1.png", (10, 7), (0, 40 * i, 0, 255))
+        self.make_metadata("<screenshots>%s</screenshots>" % "".join(
+            "<screenshot><name>%s</name><tile_width>1</tile_width><tile_height>2</tile_height></screenshot>" % name
+            for name in names))
+
+        self.recorder.record()
+        serialdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, serialdir)
+        Recorder(self.inputdir, serialdir, jobs=1).record()
+
+        for name in names:
+            with open(join(self.outputdir, name + ".png"), "rb") as f1, \
+                 open(join(serialdir, name + ".png"), "rb") as f2:
+                self.assertEqual(f2.read(), f1.read())
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,6 +15,7 @@ from __future__ import unicode_literals
 
 import unittest
 from .simple_puller import SimplePuller
+from . import pull_screenshots
 import subprocess
 import tempfile
 from .common import get_adb
@@ -22,6 +23,11 @@ import shutil
 import os
 from . import common
 
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
 class TestSimplePuller(unittest.TestCase):
     def setUp(self):
         self.puller = SimplePuller()
@@ -45,6 +51,20 @@ class TestSimplePuller(unittest.TestCase):
         with open(file, "rt") as f2:
             self.assertEqual("foobar\n", f2.read())
 
+    def test_pull_dir_integration(self):
+        dest = os.path.join(self.tmpdir, "dir")
+        subprocess.check_call([
+            get_adb(), "shell",
+            "mkdir -p /sdcard/blahdir && echo foobar > /sdcard/blahdir/blah"])
+        try:
+            self.puller.pull_dir("/sdcard/blahdir", dest)
+        finally:
+            subprocess.check_call([
+                get_adb(), "shell", "rm", "-rf", "/sdcard/blahdir"])
+
+        with open(os.path.join(dest, "blah"), "rt") as f2:
+            self.assertEqual("foobar\n", f2.read())
+
     def test_file_exists(self):
         self.assertTrue(self.puller.remote_file_exists("/sdcard/blah"))
         self.assertFalse(self.puller.remote_file_exists("/sdcard/sdfdsfdf"))
@@ -61,5 +81,32 @@ class TestSimplePuller(unittest.TestCase):
         ]
         self.assertIn(self.puller.get_external_data_dir(), accepted_dirs)
 
+class TestSimplePullerInstrument(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('subprocess.check_call')
+    @patch('subprocess.Popen')
+    def test_failed_instrumentation(self, popen, check_call):
+        output = [b"INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+                  b"INSTRUMENTATION_STATUS_CODE: -1\r\n",
+                  b"INSTRUMENTATION_STATUS: test=testFoo\r\n",
+                  b"INSTRUMENTATION_STATUS_CODE: -2\r\n",
+                  b"INSTRUMENTATION_CODE: -1\r\n"]
+        popen.return_value.stdout.readline.side_effect = output + [b""]
+        popen.return_value.wait.return_value = 0
+
+        with patch('sys.stdout'):
+            self.assertRaises(RuntimeError, pull_screenshots.pull_during_instrumentation,
+                              "com.foo.tests/Runner", self.tmpdir, adb_puller=SimplePuller())
+
+        # the announced file is still pulled and removed
+        commands = [c[0][0][-3:] for c in check_call.call_args_list]
+        self.assertIn(["pull", "/sdcard/foo.png", os.path.join(self.tmpdir, "foo.png")], commands)
+        self.assertIn(["rm", "-f", "/sdcard/foo.png"], commands)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+from os.path import join
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from unittest.mock import *
+except ImportError:
+    from mock import *
+
+from .sync_puller import SyncPuller, AdbError
+from . import pull_screenshots
+from .common import md5sum
+
+CURRENT_DIR = os.path.dirname(__file__)
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """A local stand-in for the adb server, which serves the files of a
+    fixture directory as if it was the root of the device"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root, serial="emulator-5554"):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeAdbHandler)
+        self.root = root
+        self.serial = serial
+        self.connections = 0
+        self.shell_commands = []
+        self.instrument_output = ("INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n"
+                                  "INSTRUMENTATION_CODE: -1\r\n")
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def local_path(self, path):
+        return self.root + path
+
+    def run_shell(self, command):
+        self.shell_commands.append(command)
+        if command == "echo $EXTERNAL_STORAGE":
+            return "/sdcard\n"
+        if command.startswith("cd ") and command.endswith(" && find . -maxdepth 1 -type f -exec md5sum {} +"):
+            path = self.local_path(command[len("cd "):command.index(" && ")])
+            return "".join("%s  ./%s\n" % (md5sum(join(path, f)), f) for f in sorted(os.listdir(path)))
+        if command.startswith("am instrument "):
+            return self.instrument_output
+        return ""
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        transport = self.read_request()
+        if transport not in ("host:transport-any",
+                             "host:transport-usb",
+                             "host:transport-local",
+                             "host:transport:" + self.server.serial):
+            return self.fail("device not found")
+        self.okay()
+
+        service = self.read_request()
+        if service == "sync:":
+            self.okay()
+            try:
+                self.sync()
+            except EOFError:
+                pass  # the client closed the session without QUIT
+        elif service.startswith("shell:"):
+            self.okay()
+            self.request.sendall(self.server.run_shell(service[len("shell:"):]).encode('utf-8'))
+        else:
+            self.fail("unknown service " + service)
+
+    def sync(self):
+        while True:
+            command, length = struct.unpack("<4sI", self.recv(8))
+            if command == b"QUIT":
+                return
+            path = self.server.local_path(self.recv(length).decode('utf-8'))
+
+            if command == b"STAT":
+                if os.path.exists(path):
+                    st = os.stat(path)
+                    self.request.sendall(b"STAT" + struct.pack("<III", st.st_mode, st.st_size, int(st.st_mtime)))
+                else:
+                    self.request.sendall(b"STAT" + struct.pack("<III", 0, 0, 0))
+            elif command == b"RECV":
+                if not os.path.isfile(path):
+                    message = b"No such file or directory"
+                    self.request.sendall(b"FAIL" + struct.pack("<I", len(message)) + message)
+                    return
+                with open(path, "rb") as f:
+                    data = f.read()
+                for i in range(0, len(data), 1024):
+                    chunk = data[i:i + 1024]
+                    self.request.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                self.request.sendall(b"DONE" + struct.pack("<I", 0))
+            elif command == b"LIST":
+                for name in [".", ".."] + sorted(os.listdir(path)):
+                    st = os.stat(join(path, name))
+                    name = name.encode('utf-8')
+                    self.request.sendall(b"DENT" + struct.pack("<IIII", st.st_mode, st.st_size,
+                                                               int(st.st_mtime), len(name)) + name)
+                self.request.sendall(b"DONE" + struct.pack("<IIII", 0, 0, 0, 0))
+            else:
+                return
+
+    def read_request(self):
+        length = int(self.recv(4), 16)
+        return self.recv(length).decode('utf-8')
+
+    def okay(self):
+        self.request.sendall(b"OKAY")
+
+    def fail(self, message):
+        message = message.encode('utf-8')
+        self.request.sendall(b"FAIL" + ("%04x" % len(message)).encode('ascii') + message)
+
+    def recv(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+class TestSyncPuller(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAdbServer(join(CURRENT_DIR, "fixtures"))
+        self.puller = SyncPuller(port=self.server.port)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.puller.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_exists(self):
+        self.assertTrue(self.puller.remote_file_exists("/sdcard"))
+        self.assertTrue(self.puller.remote_file_exists(
+            "/sdcard/screenshots/com.foo/screenshots-default/metadata.xml"))
+        self.assertFalse(self.puller.remote_file_exists("/sdcard/sdfdsfdf"))
+
+    def test_pull(self):
+        dest = join(self.tmpdir, "metadata.xml")
+        src = "/sdcard/screenshots/com.foo/screenshots-default/metadata.xml"
+        self.puller.pull(src, dest)
+
+        with open(dest, "rb") as f1, open(self.server.local_path(src), "rb") as f2:
+            self.assertEqual(f2.read(), f1.read())
+
+    def test_pull_missing_file(self):
+        try:
+            self.puller.pull("/sdcard/sdfdsfdf", join(self.tmpdir, "foo"))
+            self.fail("expected exception")
+        except AdbError as e:
+            self.assertIn("No such file", e.args[0])
+
+        # the next command gets a fresh session
+        self.assertTrue(self.puller.remote_file_exists("/sdcard"))
+
+    def test_session_is_reused(self):
+        src = "/sdcard/screenshots/com.foo/screenshots-default/"
+        for name in ["metadata.xml", "one_dump.xml"]:
+            self.assertTrue(self.puller.remote_file_exists(src + name))
+            self.puller.pull(src + name, join(self.tmpdir, name))
+
+        self.assertEqual(1, self.server.connections)
+
+    def test_pull_dir(self):
+        dest = join(self.tmpdir, "files")
+        self.puller.pull_dir("/sdcard/screenshots/com.foo/screenshots-default", dest)
+
+        self.assertEqual(
+            sorted(os.listdir(self.server.local_path("/sdcard/screenshots/com.foo/screenshots-default"))),
+            sorted(os.listdir(dest)))
+
+    def test_get_external_data_dir(self):
+        self.assertEqual("/sdcard", self.puller.get_external_data_dir())
+        self.assertEqual("/sdcard", self.puller.get_external_data_dir())
+        self.assertEqual(["echo $EXTERNAL_STORAGE"], self.server.shell_commands)
+
+    def test_remote_checksums(self):
+        src = "/sdcard/screenshots/com.foo/screenshots-default"
+        checksums = self.puller.remote_checksums(src)
+
+        self.assertEqual(md5sum(self.server.local_path(src + "/one_dump.xml")),
+                         checksums["one_dump.xml"])
+        self.assertEqual(sorted(os.listdir(self.server.local_path(src))), sorted(checksums))
+
+    def test_instrument(self):
+        lines = list(self.puller.instrument("com.foo.tests/Runner", {"HostFileSender_supported": "true"}))
+
+        self.assertEqual(["am instrument -r -w -e HostFileSender_supported true com.foo.tests/Runner"],
+                         self.server.shell_commands)
+        self.assertEqual(["INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/foo.png\r\n",
+                          "INSTRUMENTATION_CODE: -1\r\n"],
+                         lines)
+
+    def test_failed_instrumentation(self):
+        png = "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"
+        self.server.instrument_output = (
+            "INSTRUMENTATION_STATUS: HostFileSender_filename=/sdcard/screenshots/com.foo/screenshots-default/%s\r\n"
+            "INSTRUMENTATION_STATUS_CODE: -1\r\n"
+            "INSTRUMENTATION_RESULT: shortMsg=Process crashed.\r\n"
+            "INSTRUMENTATION_CODE: 0\r\n" % png)
+
+        with patch('sys.stdout'):
+            self.assertRaises(RuntimeError, pull_screenshots.pull_during_instrumentation,
+                              "com.foo.tests/Runner", self.tmpdir, adb_puller=self.puller)
+
+        # the files announced before the crash are still pulled
+        self.assertEqual([png], os.listdir(self.tmpdir))
+
+    def test_remove(self):
+        self.puller.remove("/sdcard/foo.png")
+        self.assertEqual(["rm -f /sdcard/foo.png"], self.server.shell_commands)
+
+    def test_serial(self):
+        self.assertTrue(SyncPuller(["-s", "emulator-5554"], port=self.server.port)
+                        .remote_file_exists("/sdcard"))
+
+    def test_unknown_serial(self):
+        try:
+            SyncPuller(["-s", "emulator-1234"], port=self.server.port).remote_file_exists("/sdcard")
+            self.fail("expected exception")
+        except AdbError as e:
+            self.assertIn("device not found", e.args[0])
+
+    def test_pull_screenshots(self):
+        pull_screenshots.pull_all("com.foo", self.tmpdir, adb_puller=self.puller, jobs=2)
+
+        self.assertEqual(["com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png",
+                          "com.foo.ScriptsFixtureTest_testSecondScreenshot.png",
+                          "metadata.xml",
+                          "one_dump.xml"],
+                         sorted(os.listdir(self.tmpdir)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os.path import join
+
+from PIL import Image
+
+from . import thumbnails
+from .metadata import Screenshot, ScreenshotIndex
+
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+class TestThumbnails(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.index = ScreenshotIndex([Screenshot("foo", tile_width=1, tile_height=2),
+                                      Screenshot("bar", error="Out of memory")])
+        self.create_tile("foo.png", (300, 500), "blue")
+        self.create_tile("foo_0_1.png", (300, 100), "red")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        shutil.rmtree(self.cache)
+
+    def create_tile(self, name, size, color):
+        Image.new("RGBA", size, color).save(join(self.dir, name))
+
+    def generate(self, **kwargs):
+        return thumbnails.generate_thumbnails(self.dir, self.index, cache_dir=self.cache, **kwargs)
+
+    def test_thumbnail(self):
+        self.assertEqual({"foo": join(thumbnails.THUMBNAIL_DIR, "foo.png")}, self.generate())
+
+        with Image.open(join(self.dir, thumbnails.THUMBNAIL_DIR, "foo.png")) as im:
+            self.assertEqual((240, 480), im.size)
+            self.assertEqual((0, 0, 255, 255), im.getpixel((120, 10)))
+            self.assertEqual((255, 0, 0, 255), im.getpixel((120, 460)))
+
+    def test_thumbnails_are_cached(self):
+        self.generate()
+        with patch.object(thumbnails, "_stitch") as mock_stitch:
+            self.generate()
+            self.assertFalse(mock_stitch.called)
+        self.assertTrue(os.path.exists(join(self.dir, thumbnails.THUMBNAIL_DIR, "foo.png")))
+
+    def test_changed_tiles_are_not_served_from_cache(self):
+        self.generate()
+        self.create_tile("foo_0_1.png", (300, 100), "green")
+        self.generate()
+
+        with Image.open(join(self.dir, thumbnails.THUMBNAIL_DIR, "foo.png")) as im:
+            self.assertEqual((0, 128, 0, 255), im.getpixel((120, 460)))
+
+    def test_missing_tiles(self):
+        os.unlink(join(self.dir, "foo_0_1.png"))
+        self.assertEqual({}, self.generate())
+
+    def test_default_cache_is_in_the_report(self):
+        thumbnails.generate_thumbnails(self.dir, self.index)
+        self.assertEqual(1, len(os.listdir(join(self.dir, thumbnails.THUMBNAIL_CACHE))))
+
+    def test_jobs(self):
+        self.index = ScreenshotIndex([Screenshot("foo", tile_width=1, tile_height=2),
+                                      Screenshot("baz", tile_width=1, tile_height=1)])
+        self.create_tile("baz.png", (10, 10), "blue")
+
+        self.assertEqual(["baz", "foo"], sorted(self.generate(jobs=2)))
+        # both have their own cache entry
+        self.assertEqual(2, len(os.listdir(self.cache)))
+
+if __name__ == '__main__':
+    unittest.main()
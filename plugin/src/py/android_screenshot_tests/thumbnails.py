@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+
+# Downscaled previews of the stitched screenshots, shown in the report
+# instead of the full resolution tiles. Thumbnails are cached by the
+# contents of their tiles, so a screenshot whose tiles didn't change
+# since the last run (with the same cache) isn't stitched again.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import shutil
+
+from os.path import join
+from PIL import Image
+
+from . import common
+from .golden_store import REPORT_PNG_PROFILE, file_hash, save_png
+from .recorder import _stitch, parallel_map
+
+# Written into the report directory, with one thumbnail per screenshot
+THUMBNAIL_DIR = "thumbnails"
+
+# The default cache, in the report directory (so it's reused when the
+# same --temp-dir is)
+THUMBNAIL_CACHE = "thumbnail_cache"
+
+# Thumbnails fit in this box, keeping the aspect ratio of the screenshot
+THUMBNAIL_SIZE = (240, 480)
+
+def _tiles(dir, name, w, h):
+    return [join(dir, common.get_image_file_name(name, i, j))
+            for j in range(h) for i in range(w)]
+
+def _cache_key(tiles, w, h, size):
+    digest = hashlib.sha1(("%dx%d tiles, %dx%d thumbnail" % (w, h, size[0], size[1])).encode('ascii'))
+    for tile in tiles:
+        digest.update(file_hash(tile).encode('ascii'))
+    return digest.hexdigest()
+
+def _thumbnail(args):
+    """Writes the thumbnail of a single screenshot into the report, from
+    the cache if possible. Returns its path relative to the report, or
+    None if some of its tiles are missing."""
+    dir, cache_dir, name, w, h, size, png_profile = args
+    tiles = _tiles(dir, name, w, h)
+    if not all(os.path.exists(tile) for tile in tiles):
+        return None
+
+    cached = join(cache_dir, _cache_key(tiles, w, h, size) + ".png")
+    if not os.path.exists(cached):
+        im = _stitch(dir, name, w, h)
+        try:
+            im.thumbnail(size, Image.LANCZOS)
+            # another process may be writing the same thumbnail
+            partial = "%s.%d.tmp" % (cached, os.getpid())
+            save_png(im, partial, png_profile)
+            os.rename(partial, cached)
+        finally:
+            im.close()
+
+    thumbnail = join(THUMBNAIL_DIR, name + ".png")
+    shutil.copyfile(cached, join(dir, thumbnail))
+    return thumbnail
+
+def generate_thumbnails(dir, index, cache_dir=None, jobs=1, size=THUMBNAIL_SIZE,
+                        png_profile=REPORT_PNG_PROFILE):
+    """Writes a thumbnail of every screenshot in index into
+    dir/THUMBNAIL_DIR. Returns the paths of the thumbnails (relative to
+    dir) by screenshot name."""
+    cache_dir = cache_dir or join(dir, THUMBNAIL_CACHE)
+    for d in [join(dir, THUMBNAIL_DIR), cache_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    screenshots = [(s.name, s.tile_width, s.tile_height) for s in index if s.error is None]
+    thumbnails = parallel_map(_thumbnail, [(dir, cache_dir, name, w, h, size, png_profile)
+                                           for name, w, h in screenshots], jobs)
+    return dict((name, thumbnail)
+                for (name, w, h), thumbnail in zip(screenshots, thumbnails)
+                if thumbnail is not None)